@@ -6,6 +6,9 @@ Luis Rei <luis.rei@ijs.si> @lmrei http://luisrei.com
 """
 
 import os
+import gc
+import time
+import resource
 import argparse
 import multiprocessing
 import logging
@@ -18,9 +21,19 @@ import twokenize
 import normalize
 import sgd
 import seq
+import metrics
+from cache import text_key
 
 
-def process_message(data, router, outputs, identifier=''):
+# error for messages whose deadline passed before they were annotated
+EXPIRED = 'deadline expired'
+
+# names of the annotations a request can ask for (the tokenized text is
+# always included)
+ANNOTATIONS = frozenset(['normalizer', 'ngrams', 'sentiment', 'pos', 'ner'])
+
+
+def process_message(data, router, outputs, identifier='', cache=None):
     """This is the function that actually processes the data
     Routes data to the appropriate function for each annotation
 
@@ -29,233 +42,582 @@ def process_message(data, router, outputs, identifier=''):
         2 - POS
         3 - NER
     """
-    reply = data
+    return process_messages([data], router, outputs, identifier, cache)[0]
 
-    # message must have a lang attribute
-    if 'lang' not in data:
-        return reply
-    lang = data['lang']
 
-    # check if we are setup to handle this language
-    if lang not in router:
-        return reply
+def process_messages(data, router, outputs, identifier='', cache=None):
+    """Batch version of process_message: data is a list of messages (which
+    can be in different languages). Replies are returned in the same order.
+    Messages are grouped by language and each stage of the pipeline runs over
+    the whole group at once.
 
-    models = router[lang]
-    output = outputs[lang]
+    If a cache (cache.LRUCache) is passed, annotations for texts seen before
+    are taken from it instead of running the pipeline. Its hits, misses,
+    evictions, entries and bytes go to metrics.registry.
 
-     # check if message has a text property
-    if 'text' not in data:
-        return reply
+    A message can have a deadline (unix time): once it has passed the
+    remaining stages are skipped and the reply gets an error.
 
-    text = data['text'].strip()
+    A message can name the annotations it needs (see requested_output), only
+    the stages needed for them are run.
+
+    Invalid messages (see check_message) get an error, those that are not
+    objects are replaced by one.
+    """
+    groups = {}
+    keys = {}
+    for ii, message in enumerate(data):
+        error = check_message(message)
+        if error is not None:
+            if isinstance(message, dict):
+                message.setdefault('error', error)
+            else:
+                data[ii] = {'error': error}
+            continue
+        lang = message['lang']
+
+        # check if we are setup to handle this language
+        if lang not in router:
+            continue
+
+        # check that text field is not empty
+        if not message['text'].strip():
+            continue
+
+        output = requested_output(message, outputs[lang])
+
+        if cache is not None:
+            text = message['text'].strip()
+            key = text_key(lang, text, output, identifier)
+            annotations = cache.get(key)
+            if annotations is not None:
+                message.update(annotations)
+                metrics.registry.inc('annotator_cache_hits_total', lang=lang)
+                continue
+            metrics.registry.inc('annotator_cache_misses_total', lang=lang)
+            keys[id(message)] = key
+
+        groups.setdefault((lang, output), []).append(message)
+
+    evictions = cache.evictions if cache is not None else 0
+    for (lang, output), messages in groups.items():
+        fields = [set(message) for message in messages]
+        metrics.registry.inc('annotator_messages_total', len(messages),
+                             lang=lang)
+        process_batch(messages, router[lang], output, identifier, lang)
+
+        if cache is not None:
+            for message, before in zip(messages, fields):
+                if 'error' in message:
+                    continue
+                annotations = {k: v for k, v in message.items()
+                               if k not in before}
+                cache.put(keys[id(message)], annotations)
+
+    if cache is not None:
+        metrics.registry.inc('annotator_cache_evictions_total',
+                             cache.evictions - evictions)
+        metrics.registry.set('annotator_cache_entries', len(cache))
+        metrics.registry.set('annotator_cache_bytes', cache.bytes)
+
+    for message in data:
+        if isinstance(message, dict):
+            message.pop('deadline', None)
+
+    # replies are the messages themselves (annotated in place)
+    return data
+
+
+def check_message(message):
+    """Returns why a message can not be annotated or None if it can: it must
+    be an object with a string lang and text (and a string or list of strings
+    annotations if it has them)
+    """
+    if not isinstance(message, dict):
+        return 'message must be an object'
+    for field in ('lang', 'text'):
+        if field not in message:
+            return 'missing {}'.format(field)
+        if not isinstance(message[field], basestring):
+            return '{} must be a string'.format(field)
+    annotations = message.get('annotations', '')
+    if isinstance(annotations, list):
+        if not all(isinstance(x, basestring) for x in annotations):
+            return 'annotations must be strings'
+    elif not isinstance(annotations, basestring):
+        return 'annotations must be a string or a list'
+    return None
+
+
+def requested_output(message, output):
+    """Returns the annotations to produce for a message: the ones named in its
+    annotations field (a list or a comma separated string) that are configured
+    for its language, or all of them if it does not have one. Names that are
+    not in ANNOTATIONS are reported in the message's warning field.
+    """
+    annotations = message.pop('annotations', None)
+    if annotations is None:
+        return frozenset(output)
+    if isinstance(annotations, basestring):
+        annotations = annotations.split(',')
+    annotations = frozenset(x.strip() for x in annotations) - frozenset([''])
+    unknown = annotations - ANNOTATIONS
+    if unknown:
+        message['warning'] = 'unknown annotations: {} (valid: {})'.format(
+            ', '.join(sorted(unknown)), ', '.join(sorted(ANNOTATIONS)))
+    return annotations & frozenset(output)
+
+
+def run_stage(models, name, items, lang=''):
+    """Runs a pipeline stage over a list of inputs. Uses the batch version of
+    the stage (name + '_many') if there is one in the router.
+    The time it takes is recorded in metrics.registry.
+    """
+    start = time.time()
+    batch_f = models.get(name + '_many')
+    if batch_f is not None:
+        results = batch_f(items)
+    else:
+        f = models[name]
+        results = [f(x) for x in items]
+
+    metrics.registry.observe('annotator_stage_seconds', time.time() - start,
+                             lang=lang, stage=name)
+    metrics.registry.inc('annotator_stage_items_total', len(items),
+                         lang=lang, stage=name)
+    return results
+
+
+def drop_expired(messages, *columns):
+    """Removes the messages whose deadline has passed (and their items in the
+    other lists) before a pipeline stage. Expired messages get an error.
+    Returns the messages and the other lists.
+    """
+    now = time.time()
+    keep = [ii for ii, message in enumerate(messages)
+            if message.get('deadline', now + 1) > now]
+    if len(keep) == len(messages):
+        return (messages,) + columns
 
-    # check that text field is not empty
-    if not text:
-        return reply
+    for message in messages:
+        if message.get('deadline', now + 1) <= now:
+            message['error'] = EXPIRED
+    return tuple([column[ii] for ii in keep]
+                 for column in (messages,) + columns)
+
+
+def process_batch(messages, models, output, identifier='', lang=''):
+    """Runs the pipeline for a list of valid messages of the same language
+    """
+    texts = [message['text'].strip() for message in messages]
 
     #
     # Pipeline begins
     #
+    messages, texts = drop_expired(messages, texts)
     property = identifier + 'tokenized'
-    tokenizer = models['tokenizer']
+    texts = run_stage(models, 'tokenizer', texts, lang)
+    tokens = [text.split() for text in texts]   # to be used with NER/POS
 
-    text = tokenizer(text)
-    tokens = text.split()   # to be used with NER/POS
-
-    reply[property] = text
+    for message, text in zip(messages, texts):
+        message[property] = text
 
     #
-    # 0 - Preprocess text, generate ngrams
-    # 
-    preprocessor = models['preprocessor']
-    text_pp = preprocessor(text)  # this is passed on to the sentiment classif
-
-    # text is normalized 
-    if 'normalizer' in models:
+    # 0 - Normalize text, generate ngrams
+    #
+    # text is normalized
+    if 'normalizer' in models and ('normalizer' in output or
+                                   'ngrams' in output):
+        messages, texts, tokens = drop_expired(messages, texts, tokens)
         property = identifier + 'norm'
-        normalizer = models['normalizer']
-        text_norm = normalizer(text)
+        texts_norm = run_stage(models, 'normalizer', texts, lang)
         if 'normalizer' in output:
-            reply[property] = text_norm
+            for message, text_norm in zip(messages, texts_norm):
+                message[property] = text_norm
 
         # then ngrams are generated
         property = identifier + 'ngrams'
         if 'ngrams' in output:
+            start = time.time()
             ngramer = models['ngrams']
-            reply[property] = list(ngramer(text_norm.split()))
+            for message, text_norm in zip(messages, texts_norm):
+                message[property] = list(ngramer(text_norm.split()))
+            metrics.registry.observe('annotator_stage_seconds',
+                                     time.time() - start, lang=lang,
+                                     stage='ngrams')
+            metrics.registry.inc('annotator_stage_items_total',
+                                 len(messages), lang=lang, stage='ngrams')
 
     #
     # 1 - Sentiment
     #
     if 'sentiment' in models and 'sentiment' in output:
+        # preprocessed text is passed on to the sentiment classif
+        messages, texts, tokens = drop_expired(messages, texts, tokens)
+        texts_pp = run_stage(models, 'preprocessor', texts, lang)
+
         property = identifier + 'sentiment'
-        classifier = models['sentiment']
-        reply[property] = classifier(text_pp)
+        messages, tokens, texts_pp = drop_expired(messages, tokens, texts_pp)
+        labels = run_stage(models, 'sentiment', texts_pp, lang)
+        for message, label in zip(messages, labels):
+            message[property] = label
 
     #
     # 2 - PoS
     #
     if 'pos' in models and 'pos' in output:
         property = identifier + 'pos'
-        pos_tag = models['pos']
-        reply[property] = pos_tag(tokens)
+        messages, tokens = drop_expired(messages, tokens)
+        tagged = run_stage(models, 'pos', tokens, lang)
+        for message, tags in zip(messages, tagged):
+            message[property] = tags
 
     #
     # 3 - NER
     #
     if 'ner' in models and 'ner' in output:
         property = identifier + 'ne'
-        ner = models['ner']
-        reply[property] = ner(tokens)
+        messages, tokens = drop_expired(messages, tokens)
+        tagged = run_stage(models, 'ner', tokens, lang)
+        for message, tags in zip(messages, tagged):
+            message[property] = tags
 
+    return messages
 
-    # finally return:
-    return reply
+
+def config_languages(config):
+    """Returns the (sorted) languages in a config object
+    """
+    sections = config.sections()
+    langs = [x for x in sections if x not in ['service', 'external', 'codes']]
+    return sorted(list(set(langs)))
 
 
-def create_router(config):
+def create_router(config, lazy=False, idle_timeout=0, memory_budget=0):
     """Given a config object, returns the router and output dictionaries
+
+    If lazy, each language is only loaded on its first request and can be
+    evicted (see LazyRouter).
     """
+    langs = config_languages(config)
+    logging.info('languages in configuration: {}'.format(str(langs)))
+
+    if lazy:
+        router = LazyRouter(config, langs, idle_timeout, memory_budget)
+        return router, router.outputs
+
     router = {}
     outputs = {}
-    sections = config.sections()
-    langs = [x for x in sections if x not in ['service', 'external', 'codes']]
-    langs = sorted(list(set(langs)))
+    for lang in langs:
+        router[lang], outputs[lang] = load_language(config, lang)
 
-    langmap = {k: v for k, v in config.items('codes')}
+    return router, outputs
 
-    logging.info('languages in configuration: {}'.format(str(langs)))
 
+def resident_memory():
+    """Returns the resident set size of this process in bytes (0 if unknown)
+    """
+    try:
+        with open('/proc/self/statm') as fin:
+            return int(fin.read().split()[1]) * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return 0
 
-    stanford_ner = config.get('external', 'stanford_ner')
-    stanford_ner = os.path.abspath(stanford_ner)
-    stanford_pos = config.get('external', 'stanford_pos')
-    stanford_pos = os.path.abspath(stanford_pos)
 
-    for lang in langs:
-        logging.info('loading config for {}'.format(lang))
-        router[lang] = {}
-        outputs[lang] = set()
-
-        # tokenizer
-        tokenizer = config.get(lang, 'tokenizer')
-        if tokenizer == 'twokenizer':
-            router[lang]['tokenizer'] = twokenize.tokenize
-        elif tokenizer == 'apostrophes':
-            router[lang]['tokenizer'] = twokenize.tokenize_apostrophes
-        else:
-            msg = 'No such tokenizer: {}'.format(tokenizer)
-            raise KeyError(msg)
+def release(models):
+    """Stops the external processes (e.g. tagger servers) used by models
+    """
+    for f in models.values():
+        keywords = getattr(f, 'keywords', None) or {}
+        for model in keywords.values():
+            if hasattr(model, 'stop'):
+                model.stop()
 
-        # preprocessor
-        preprocessor = config.get(lang, 'preprocessor')
-        if preprocessor == 'twokenizer':
-            router[lang]['preprocessor'] = twokenize.preprocess
-        else:
-            msg = 'No such preprocessor: {}'.format(preprocessor)
-            raise KeyError(msg)
 
-        # ngrams
-        n = 3
+def config_outputs(config, lang):
+    """Returns the outputs configured for a language without loading its
+    models (load_language can still drop those whose models fail to load)
+    """
+    def enabled(option):
         try:
-            n = config.getint(lang, 'ngrams')
+            return config.getboolean(lang, option)
         except:
-            pass
-        router[lang]['ngrams'] = partial(ngrams, n=n)
+            return False
+
+    output = set()
+    for name in ['ngrams', 'normalizer']:
+        if enabled(name + '_out'):
+            output.add(name)
+    for name in ['sentiment', 'ner', 'pos']:
+        if config.has_option(lang, name + '_model') and enabled(name + '_out'):
+            output.add(name)
+    return output
+
+
+class LazyOutputs(object):
+    """Outputs dictionary for a LazyRouter. Looking up a language does not
+    load it: the outputs of languages that are not loaded are read from the
+    config, so requests can be answered from the cache without loading.
+    """
+    def __init__(self, router):
+        self.router = router
+
+    def __contains__(self, lang):
+        return lang in self.router
+
+    def __getitem__(self, lang):
+        if lang not in self.router:
+            raise KeyError(lang)
+        output = self.router.output.get(lang)
+        if output is None:
+            output = config_outputs(self.router.config, lang)
+        return output
+
+
+class LazyRouter(object):
+    """Router (lang -> models dictionary) that loads the models of a language
+    on its first request. Other languages are evicted when they have been idle
+    for more than idle_timeout seconds or, least recently used first, while
+    the resident size of the loaded languages is above memory_budget bytes.
+
+    The size of a language is the growth of the process' resident size while
+    loading it, so the budget is approximate: it includes other allocations
+    made meanwhile, does not count external processes (tagger servers) and
+    memory freed on eviction is not always returned to the OS.
+    """
+    def __init__(self, config, langs, idle_timeout=0, memory_budget=0):
+        self.config = config
+        self.langs = set(langs)
+        self.idle_timeout = idle_timeout
+        self.memory_budget = memory_budget
+        self.models = {}
+        self.output = {}
+        self.sizes = {}
+        self.last_used = {}
+        self.outputs = LazyOutputs(self)
+
+    def __contains__(self, lang):
+        return lang in self.langs
+
+    def __iter__(self):
+        return iter(sorted(self.langs))
+
+    def __getitem__(self, lang):
+        return self.load(lang)[0]
+
+    def load(self, lang):
+        """Returns the models and outputs for lang, loading them if needed
+        """
+        if lang not in self.langs:
+            raise KeyError(lang)
+
+        self.last_used[lang] = time.time()
+        if lang not in self.models:
+            start = time.time()
+            before = resident_memory()
+            self.models[lang], self.output[lang] = load_language(self.config,
+                                                                 lang)
+            self.sizes[lang] = max(0, resident_memory() - before)
+            m = 'loaded {} in {:.2f}s, resident size {:.1f}MB'
+            logging.info(m.format(lang, time.time() - start,
+                                  self.sizes[lang] / 2.0 ** 20))
+
+        self.evict(keep=lang)
+        return self.models[lang], self.output[lang]
+
+    def evict(self, keep=None):
+        """Unloads idle languages and enforces the memory budget
+        """
+        now = time.time()
+        for lang in sorted(self.models, key=lambda x: self.last_used[x]):
+            if lang == keep:
+                continue
+            idle = (self.idle_timeout and
+                    now - self.last_used[lang] > self.idle_timeout)
+            over = (self.memory_budget and
+                    sum(self.sizes.values()) > self.memory_budget)
+            if idle or over:
+                self.unload(lang)
+
+    def unload(self, lang):
+        release(self.models.pop(lang))
+        del self.output[lang]
+        size = self.sizes.pop(lang)
+        gc.collect()
+        m = 'evicted {} (resident size {:.1f}MB)'
+        logging.info(m.format(lang, size / 2.0 ** 20))
+
+
+def load_language(config, lang):
+    """Loads the models for a language, returns the models and output
+    dictionaries for it
+    """
+    langmap = {k: v for k, v in config.items('codes')}
 
-        out = False
-        try:
-            out = config.getboolean(lang, 'ngrams_out')
-        except:
-            pass
-        if out:
-            outputs[lang].add('ngrams')
+    stanford_ner = config.get('external', 'stanford_ner')
+    stanford_ner = os.path.abspath(stanford_ner)
+    stanford_pos = config.get('external', 'stanford_pos')
+    stanford_pos = os.path.abspath(stanford_pos)
 
-        # normalizer
-        t = 'basic'
-        try:
-            t = config.get(lang, 'normalizer_type')
-        except:
-            pass
-        if t == 'basic':
-            model =  normalize.Normalizer(langmap[lang])
-            normalizer = partial(normalize.normalize, model=model) 
-            router[lang]['normalizer'] = normalizer
+    logging.info('loading config for {}'.format(lang))
+    models = {}
+    output = set()
+
+    # tokenizer
+    tokenizer = config.get(lang, 'tokenizer')
+    if tokenizer == 'twokenizer':
+        models['tokenizer'] = twokenize.tokenize
+    elif tokenizer == 'apostrophes':
+        models['tokenizer'] = twokenize.tokenize_apostrophes
+    elif tokenizer == 'twokenizer_fast':
+        models['tokenizer'] = twokenize.tokenize_fast
+    elif tokenizer == 'apostrophes_fast':
+        models['tokenizer'] = twokenize.tokenize_apostrophes_fast
+    else:
+        msg = 'No such tokenizer: {}'.format(tokenizer)
+        raise KeyError(msg)
+
+    # preprocessor
+    preprocessor = config.get(lang, 'preprocessor')
+    if preprocessor == 'twokenizer':
+        models['preprocessor'] = twokenize.preprocess
+    else:
+        msg = 'No such preprocessor: {}'.format(preprocessor)
+        raise KeyError(msg)
+
+    # ngrams
+    n = 3
+    try:
+        n = config.getint(lang, 'ngrams')
+    except:
+        pass
+    models['ngrams'] = partial(ngrams, n=n)
+
+    out = False
+    try:
+        out = config.getboolean(lang, 'ngrams_out')
+    except:
+        pass
+    if out:
+        output.add('ngrams')
+
+    # normalizer
+    t = 'basic'
+    try:
+        t = config.get(lang, 'normalizer_type')
+    except:
+        pass
+    if t == 'basic':
+        model =  normalize.Normalizer(langmap[lang])
+        normalizer = partial(normalize.normalize, model=model) 
+        models['normalizer'] = normalizer
+    elif t == 'fast':
+        model = normalize.FastNormalizer(langmap[lang])
+        normalizer = partial(normalize.normalize, model=model)
+        models['normalizer'] = normalizer
+    else:
+        msg = 'No such normalizer: {}'.format(t)
+        raise KeyError(msg)
+    out = False
+    try:
+        out = config.getboolean(lang, 'normalizer_out')
+    except:
+        pass
+    if out:
+        output.add('normalizer')
+
+    # sentiment
+    try:
+        sentiment_model = config.get(lang, 'sentiment_model')
+        out = config.getboolean(lang, 'sentiment_out')
+        t = config.get(lang, 'sentiment_type')
+        if t == 'sgd':
+            model = sgd.load(sentiment_model)
+        elif t == 'compact':
+            model = sgd.load_compact(sentiment_model)
+        elif t == 'fused':
+            model = sgd.compile_fused(sgd.load(sentiment_model))
         else:
-            msg = 'No such normalizer: {}'.format(t)
+            msg = 'No such sentiment type: {}'.format(t)
             raise KeyError(msg)
-        out = False
-        try:
-            out = config.getboolean(lang, 'normalizer_out')
-        except:
-            pass
+        classifier = partial(sgd.classify, clf=model)
+        classifier_many = partial(sgd.classify_many, clf=model)
         if out:
-            outputs[lang].add('normalizer')
-
-        # sentiment
+            models['sentiment'] = classifier
+            models['sentiment_many'] = classifier_many
+            output.add('sentiment')
+        else:
+            logging.warning('No sentiment classifier for: {}'.format(lang))
+    except Exception as ex:
+        logging.warning('No sentiment classifier for: {}'.format(lang))
+        logging.exception(ex)
+
+    # ner
+    if config.has_option(lang, 'ner_model'):
+        t = 'stanford'
+        model = None
         try:
-            sentiment_model = config.get(lang, 'sentiment_model')
-            out = config.getboolean(lang, 'sentiment_out')
-            model = sgd.load(sentiment_model)
-            classifier = partial(sgd.classify, clf=model)
-            if out:
-                router[lang]['sentiment'] = classifier
-                outputs[lang].add('sentiment')
+            # Get config variables for NER
+            t = config.get(lang, 'ner_type')
+            ner_model = config.get(lang, 'ner_model')
+            out = config.getboolean(lang, 'ner_out')
+
+            # NER model type switch
+            if t == 'stanford':
+                model = seq.load_ner(stanford_ner, ner_model)
+                classifier = partial(seq.ner_tag, model=model)
+            elif t == 'stanford_server':
+                pool_size = config.getint(lang, 'ner_pool')
+                model = seq.load_ner_server(stanford_ner, ner_model,
+                                            pool_size)
+                classifier = partial(seq.ner_tag, model=model)
             else:
-                logging.warning('No sentiment classifier for: {}'.format(lang))
+                msg = 'No such NER type: {}'.format(t)
+                raise KeyError(msg)
+            classifier_many = partial(seq.ner_tag_many, model=model)
+
+            # Check output
+            if out and model is not None:
+                models['ner'] = classifier
+                models['ner_many'] = classifier_many
+                output.add('ner')
+            else:
+                logging.warning('No NER for: {}'.format(lang))
+
         except Exception as ex:
-            logging.warning('No sentiment classifier for: {}'.format(lang))
+            logging.warning('No NER for: {}'.format(lang))
             logging.exception(ex)
 
-        # ner
-        if config.has_option(lang, 'ner_model'):
-            t = 'stanford'
-            model = None
-            try:
-                # Get config variables for NER
-                t = config.get(lang, 'ner_type')
-                ner_model = config.get(lang, 'ner_model')
-                out = config.getboolean(lang, 'ner_out')
-
-                # NER model type switch
-                if t == 'stanford':
-                    model = seq.load_ner(stanford_ner, ner_model)
-                    classifier = partial(seq.ner_tag, model=model)
-                else:
-                    msg = 'No such NER type: {}'.format(t)
-                    raise KeyError(msg)
-
-                # Check output
-                if out and model is not None:
-                    router[lang]['ner'] = classifier
-                    outputs[lang].add('ner')
-                else:
-                    logging.warning('No NER for: {}'.format(lang))
-
-            except Exception as ex:
-                logging.warning('No NER for: {}'.format(lang))
-                logging.exception(ex)
-
-        # pos
-        if config.has_option(lang, 'pos_model'):
-            t = 'stanford'
-            model = None
-            try:
-                t = config.get(lang, 'pos_type')
-                pos_model = config.get(lang, 'pos_model')
-                out = config.getboolean(lang, 'pos_out')
-                posmap = config.get(lang, 'pos_map')
-                if t == 'stanford':
-                    model = seq.load_pos(stanford_pos, pos_model, posmap)
-                    classifier = partial(seq.pos_tag, model=model)
-                if out and model is not None:
-                    router[lang]['pos'] = classifier
-                    outputs[lang].add('pos')
-                else:
-                    logging.warning('No POS Tagger for: {}'.format(lang))
-            except Exception as ex:
+    # pos
+    if config.has_option(lang, 'pos_model'):
+        t = 'stanford'
+        model = None
+        try:
+            t = config.get(lang, 'pos_type')
+            pos_model = config.get(lang, 'pos_model')
+            out = config.getboolean(lang, 'pos_out')
+            posmap = config.get(lang, 'pos_map')
+            if t == 'stanford':
+                model = seq.load_pos(stanford_pos, pos_model, posmap)
+                classifier = partial(seq.pos_tag, model=model)
+            elif t == 'stanford_server':
+                pool_size = config.getint(lang, 'pos_pool')
+                model = seq.load_pos_server(stanford_pos, pos_model,
+                                            posmap, pool_size)
+                classifier = partial(seq.pos_tag, model=model)
+            else:
+                msg = 'No such POS type: {}'.format(t)
+                raise KeyError(msg)
+            classifier_many = partial(seq.pos_tag_many, model=model)
+            if out and model is not None:
+                models['pos'] = classifier
+                models['pos_many'] = classifier_many
+                output.add('pos')
+            else:
                 logging.warning('No POS Tagger for: {}'.format(lang))
-                logging.exception(ex)
+        except Exception as ex:
+            logging.warning('No POS Tagger for: {}'.format(lang))
+            logging.exception(ex)
 
+    return models, output
 
-    return router, outputs
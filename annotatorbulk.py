@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+xLiMe Annotator - offline bulk mode
+
+Annotates a large NDJSON file (optionally gzip compressed) with a pool of
+worker processes and writes the annotated documents as NDJSON in input order:
+
+    ./annotatorbulk.py tweets.ndjson.gz annotated.ndjson --config annotator.cfg
+
+The input is read in chunks of lines, each chunk is annotated by a worker
+with process_messages. After each chunk is written the input and output byte
+offsets are saved to <output>.checkpoint, an interrupted run (CONTROL + C or
+a crash) resumes from there when started again with the same arguments.
+"""
+
+import os
+import io
+import gzip
+import json
+import time
+import signal
+import argparse
+import logging
+import multiprocessing
+from collections import deque
+
+from annotatorsevice import init_config, read_config_file, setup_logging
+from annotator import process_messages, create_router
+from gracefulinterrupthandler import GracefulInterruptHandler
+
+
+DEFAULT_CHUNK_SIZE = 1000
+PROGRESS_INTERVAL = 10
+
+# set before the worker processes are forked
+worker_router = None
+worker_outputs = None
+
+
+def open_input(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return io.open(path, 'rb')
+
+
+def read_chunks(fin, chunk_size, offset=0):
+    '''Yields (lines, input offset after them) for chunks of chunk_size
+    non-empty lines
+    '''
+    lines = []
+    for line in fin:
+        offset += len(line)
+        if not line.strip():
+            continue
+        lines.append(line)
+        if len(lines) == chunk_size:
+            yield lines, offset
+            lines = []
+    if lines:
+        yield lines, offset
+
+
+def ignore_interrupt():
+    '''Worker initializer: interrupts are handled by the main process
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def annotate_chunk(lines):
+    '''Annotates a chunk of NDJSON lines, returns the annotated NDJSON.
+    Lines that are not valid JSON are replaced by an error, as are documents
+    that can not be annotated (see annotator.check_message).
+    '''
+    docs = []
+    for line in lines:
+        try:
+            docs.append(json.loads(line))
+        except ValueError as e:
+            docs.append({'error': str(e)})
+
+    docs = process_messages(docs, worker_router, worker_outputs)
+    return ''.join(json.dumps(doc) + '\n' for doc in docs)
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as fin:
+        return json.load(fin)
+
+
+def save_checkpoint(path, checkpoint):
+    '''Writes the checkpoint atomically
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fout:
+        json.dump(checkpoint, fout)
+    os.rename(tmp_path, path)
+
+
+def annotate_file(input_path, output_path, n_jobs, chunk_size=DEFAULT_CHUNK_SIZE,
+                  restart=False):
+    '''Annotates input_path into output_path, resuming from the checkpoint
+    unless restart. Returns True if the whole input was processed.
+    '''
+    checkpoint_path = output_path + '.checkpoint'
+    checkpoint = None if restart else load_checkpoint(checkpoint_path)
+
+    if checkpoint is None:
+        checkpoint = {'input_offset': 0, 'output_offset': 0, 'lines': 0}
+        fout = io.open(output_path, 'wb')
+    else:
+        logging.info('resuming from line {}'.format(checkpoint['lines']))
+        fout = io.open(output_path, 'r+b')
+        fout.truncate(checkpoint['output_offset'])
+        fout.seek(checkpoint['output_offset'])
+
+    fin = open_input(input_path)
+    fin.seek(checkpoint['input_offset'])
+
+    pool = multiprocessing.Pool(n_jobs, ignore_interrupt)
+    pending = deque()   # (async result, input offset, lines)
+    start = last_report = time.time()
+    lines_done = 0
+    bytes_done = 0
+
+    def write_next():
+        result, input_offset, n_lines = pending.popleft()
+        data = result.get()
+        fout.write(data)
+        fout.flush()
+        os.fsync(fout.fileno())
+
+        checkpoint['input_offset'] = input_offset
+        checkpoint['output_offset'] += len(data)
+        checkpoint['lines'] += n_lines
+        save_checkpoint(checkpoint_path, checkpoint)
+        return n_lines, len(data)
+
+    finished = True
+    with GracefulInterruptHandler() as interrupt:
+        for lines, input_offset in read_chunks(fin, chunk_size,
+                                               checkpoint['input_offset']):
+            if interrupt.interrupted:
+                finished = False
+                break
+            pending.append((pool.apply_async(annotate_chunk, (lines,)),
+                            input_offset, len(lines)))
+
+            # keep a bounded number of chunks in flight
+            while len(pending) > 2 * n_jobs:
+                n_lines, n_bytes = write_next()
+                lines_done += n_lines
+                bytes_done += n_bytes
+
+            if time.time() - last_report > PROGRESS_INTERVAL:
+                last_report = time.time()
+                report(checkpoint['lines'], lines_done, bytes_done,
+                       last_report - start)
+
+        # write what was already sent to the workers
+        while pending:
+            n_lines, n_bytes = write_next()
+            lines_done += n_lines
+            bytes_done += n_bytes
+
+    pool.close()
+    pool.join()
+    fin.close()
+    fout.close()
+
+    report(checkpoint['lines'], lines_done, bytes_done, time.time() - start)
+    if finished:
+        os.remove(checkpoint_path)
+    else:
+        logging.info('interrupted, run again to resume')
+    return finished
+
+
+def report(total, lines, n_bytes, elapsed):
+    elapsed = max(elapsed, 1e-6)
+    m = '{} lines done, {:.1f} lines/s, {:.2f} MB/s out'.format(
+        total, lines / elapsed, n_bytes / elapsed / 2 ** 20)
+    logging.info(m)
+    print(m)
+
+
+def main():
+    global worker_router, worker_outputs
+
+    # Command line arguments
+    parser = argparse.ArgumentParser(description='Annotate an NDJSON file.')
+
+    parser.add_argument('input', type=str,
+                        help='NDJSON input file (.gz for gzip)')
+    parser.add_argument('output', type=str,
+                        help='annotated NDJSON output file')
+    parser.add_argument('--jobs', type=int, default=0,
+                        help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='lines per chunk')
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the checkpoint and start over')
+    parser.add_argument('--config', type=str, default=None,
+                        help='configuration file')
+
+    args = parser.parse_args()
+    config = read_config_file(init_config(), filepath=args.config)
+    setup_logging(config)
+
+    n_jobs = args.jobs
+    if n_jobs <= 0:
+        n_jobs = config.getint('service', 'workers')
+
+    # models are loaded once and shared with the forked workers
+    worker_router, worker_outputs = create_router(config)
+
+    annotate_file(args.input, args.output, n_jobs, args.chunk_size,
+                  args.restart)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,7 +18,8 @@ import multiprocessing
 import logging
 from functools import partial
 from zmqservice import serve, worker_task_builder
-from annotator import process_message, create_router
+from annotator import process_message, process_messages, create_router
+from cache import LRUCache, RequestCache
 
 
 DEFAULT_CONFIG = 'annotator.cfg'
@@ -28,6 +29,22 @@ DEFAULT_PORT = 1984
 DEFAULT_WORKERS = multiprocessing.cpu_count()
 DEFAULT_BACKEND = 'ipc://annotbackend.ipc'
 DEFAULT_FRONTEND = 'tcp://127.0.0.1:5555'
+DEFAULT_CONNECTIONS = 2
+DEFAULT_TIMEOUT = 30
+DEFAULT_HEARTBEAT = 1.0
+DEFAULT_WORKER_TIMEOUT = 60
+DEFAULT_MAX_QUEUE = 1000
+DEFAULT_BATCH_SIZE = 0
+DEFAULT_BATCH_WAIT = 5
+DEFAULT_CACHE_SIZE = 0
+DEFAULT_CACHE_TTL = 0
+DEFAULT_CACHE_MEMORY = 64
+DEFAULT_BROKER_CACHE_SIZE = 0
+DEFAULT_BROKER_CACHE_TTL = 0
+DEFAULT_BROKER_CACHE_MEMORY = 256
+DEFAULT_LAZY = False
+DEFAULT_IDLE_TIMEOUT = 0
+DEFAULT_MEMORY_BUDGET = 0
 DEFAULT_LOG = '/tmp/annotator.log'
 DEFAULT_LOGLEVEL = logging.DEBUG
 
@@ -44,11 +61,14 @@ def init_config():
                 'ngrams_out': False,
                 'preprocessor': 'twokenizer',
                 'normalizer_type': 'basic',
+                'sentiment_type': 'sgd',
                 'sentiment_out': False,
                 'ner_type': 'stanford',
                 'ner_out': False,
+                'ner_pool': 2,
                 'pos_type': 'stanford',
-                'pos_out': False
+                'pos_out': False,
+                'pos_pool': 2
                 }
 
     config = ConfigParser.RawConfigParser(defaults=defaults)
@@ -64,6 +84,39 @@ def init_config():
     # Number of workers
     config.set('service', 'workers', DEFAULT_WORKERS)
 
+    # Broker <-> worker heartbeat interval and max time on a request (seconds)
+    # before a worker is considered hung and restarted
+    config.set('service', 'heartbeat', DEFAULT_HEARTBEAT)
+    config.set('service', 'worker_timeout', DEFAULT_WORKER_TIMEOUT)
+
+    # Max requests waiting for a worker (0 for no limit), more are rejected
+    config.set('service', 'max_queue', DEFAULT_MAX_QUEUE)
+
+    # HTTP frontend: sockets to the broker and request timeout (seconds)
+    config.set('service', 'connections', DEFAULT_CONNECTIONS)
+    config.set('service', 'timeout', DEFAULT_TIMEOUT)
+
+    # Micro-batching: max requests per batch (0 disables) and max wait (ms)
+    config.set('service', 'batch_size', DEFAULT_BATCH_SIZE)
+    config.set('service', 'batch_wait', DEFAULT_BATCH_WAIT)
+
+    # Per worker result cache: max entries (0 disables), ttl (seconds, 0 for
+    # none) and memory limit (MB)
+    config.set('service', 'cache_size', DEFAULT_CACHE_SIZE)
+    config.set('service', 'cache_ttl', DEFAULT_CACHE_TTL)
+    config.set('service', 'cache_memory', DEFAULT_CACHE_MEMORY)
+
+    # Shared (broker) reply cache: same options
+    config.set('service', 'broker_cache_size', DEFAULT_BROKER_CACHE_SIZE)
+    config.set('service', 'broker_cache_ttl', DEFAULT_BROKER_CACHE_TTL)
+    config.set('service', 'broker_cache_memory', DEFAULT_BROKER_CACHE_MEMORY)
+
+    # Lazy language loading: evict languages idle for idle_timeout seconds
+    # and keep loaded models within memory_budget MB (0 for no limit)
+    config.set('service', 'lazy', str(DEFAULT_LAZY))
+    config.set('service', 'idle_timeout', DEFAULT_IDLE_TIMEOUT)
+    config.set('service', 'memory_budget', DEFAULT_MEMORY_BUDGET)
+
     # logging
     config.set('service', 'log', DEFAULT_LOG)
     config.set('service', 'loglevel', DEFAULT_LOGLEVEL)
@@ -137,6 +190,8 @@ def main():
                         help='read/write to zmq socket at specified port')
     parser.add_argument('--workers', type=int, default=0,
                         help='number of concurrent workers')
+    parser.add_argument('--batch-size', type=int, default=-1,
+                        help='micro-batch up to this many requests (0: off)')
     parser.add_argument('--config', type=str, default=None,
                         help='configuration file')
     parser.add_argument('--save-config', type=str, default=None,
@@ -155,12 +210,21 @@ def main():
         config.set('service', 'port', args.port)
     if args.workers > 0:
         config.set('service', 'workers', args.workers)
+    if args.batch_size >= 0:
+        config.set('service', 'batch_size', args.batch_size)
 
     # get final options
     port = config.get('service', 'port')
     n_workers = config.getint('service', 'workers')
     backend = config.get('service', 'backend')
     frontend = config.get('service', 'frontend')
+    batch_size = config.getint('service', 'batch_size')
+    batch_wait = config.getfloat('service', 'batch_wait')
+    n_connections = config.getint('service', 'connections')
+    heartbeat = config.getfloat('service', 'heartbeat')
+    worker_timeout = config.getfloat('service', 'worker_timeout')
+    max_queue = config.getint('service', 'max_queue')
+    timeout = config.getfloat('service', 'timeout')
 
     # Save config
     if args.save_config is not None:
@@ -170,11 +234,33 @@ def main():
     setup_logging(config)
 
     # create router
-    router, outputs = create_router(config)
+    lazy = config.getboolean('service', 'lazy')
+    idle_timeout = config.getfloat('service', 'idle_timeout')
+    memory_budget = int(config.getfloat('service', 'memory_budget') * 2 ** 20)
+    router, outputs = create_router(config, lazy, idle_timeout, memory_budget)
+
+    # create result cache (each worker process gets its own copy)
+    cache = None
+    cache_size = config.getint('service', 'cache_size')
+    if cache_size > 0:
+        cache_ttl = config.getfloat('service', 'cache_ttl')
+        cache_memory = config.getfloat('service', 'cache_memory')
+        cache = LRUCache(cache_size, cache_ttl, int(cache_memory * 2 ** 20))
+
+    # create broker reply cache
+    broker_cache = None
+    cache_size = config.getint('service', 'broker_cache_size')
+    if cache_size > 0:
+        cache_ttl = config.getfloat('service', 'broker_cache_ttl')
+        cache_memory = config.getfloat('service', 'broker_cache_memory')
+        broker_cache = RequestCache(LRUCache(cache_size, cache_ttl,
+                                             int(cache_memory * 2 ** 20)))
 
     # Setup worker function
-    f = partial(process_message, router=router, outputs=outputs)
-    worker_task = worker_task_builder(f, backend)
+    f = partial(process_message, router=router, outputs=outputs, cache=cache)
+    batch_f = partial(process_messages, router=router, outputs=outputs,
+                      cache=cache)
+    worker_task = worker_task_builder(f, backend, batch_f, heartbeat)
 
     # Print PID
     m = 'Starting Annotator Service with PID: {}'.format(os.getpid())
@@ -182,7 +268,9 @@ def main():
     print(m)
 
     # Run forever (or until kill -INT)
-    serve(port, worker_task, n_workers, backend, frontend)
+    serve(port, worker_task, n_workers, backend, frontend, batch_size,
+          batch_wait, broker_cache, n_connections, timeout, heartbeat,
+          worker_timeout, max_queue)
 
 
 if __name__ == '__main__':
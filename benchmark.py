@@ -0,0 +1,652 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the annotator components.
+
+    ./benchmark.py tagger --config annotator.cfg --lang en
+    ./benchmark.py sentiment --config annotator.cfg --lang en
+    ./benchmark.py tokenizer
+    ./benchmark.py normalizer --config annotator.cfg
+    ./benchmark.py compact --config annotator.cfg --lang en
+    ./benchmark.py fused --config annotator.cfg --lang en
+    ./benchmark.py suite --config annotator.cfg --output results.json
+    ./benchmark.py wire
+    ./benchmark.py check
+
+Each benchmark prints the throughput (items/sec) of the paths it compares.
+Benchmarks of fast paths first check that their results are the same as the
+reference ones and exit with status 1 if not; check only runs those checks
+(on small models fitted on synthetic tweets, only the languages are taken
+from the config) and checks that the broker cache does not replay expired
+replies.
+
+The suite runs every pipeline stage configured for each language (and
+process_message end to end) over synthetic tweets and writes the results as
+JSON, to compare between releases.
+"""
+
+from __future__ import print_function
+import os
+import io
+import sys
+import shutil
+import tempfile
+import json
+import time
+import random
+import string
+import platform
+import argparse
+import threading
+import subprocess
+from functools import partial
+
+import zmq
+import numpy as np
+from sklearn.pipeline import Pipeline
+from sklearn.linear_model import SGDClassifier
+from sklearn.feature_extraction.text import CountVectorizer
+
+import seq
+import sgd
+import normalize
+import twokenize
+from annotator import (process_message, config_languages, create_router,
+                       EXPIRED)
+from annotatorsevice import init_config, read_config_file
+from cache import LRUCache, RequestCache
+from zmqservice import (encode, decode, JSON, MSGPACK, worker_task_builder,
+                        zserve)
+
+
+sample_tweets = {
+    'en': [u'i hate everything because it sucks :(',
+           u'i love my iphone because apple is the best :)',
+           u'the reporter was completely impartial as am i',
+           u'Barack Obama visited New York City yesterday',
+           u'@someone check http://t.co/abc #news in London',
+           u'Angela Merkel met the Pope in Rome on Friday'],
+    'de': [u'Ich hasse alles, weil es nervt :(',
+           u'Das neue Handy ist wirklich großartig! #glücklich',
+           u'Angela Merkel traf gestern den Papst in Rom',
+           u'@jemand schau mal http://t.co/abc die Grüße aus München'],
+    'es': [u'odio vacas tontas estúpidas',
+           u'perros y gatos me hacen feliz me gustan :-)',
+           u'me lavo las manos después',
+           u'¿Qué tal? El partido en Madrid fue increíble #fútbol'],
+    'it': [u"non mi piace per niente l'app nuova :(",
+           u'che bella giornata a Roma oggi! #felice',
+           u"dell'anno scorso è stato il migliore @qualcuno",
+           u'perché il treno è sempre in ritardo? http://t.co/xyz']}
+
+
+# vocabulary for the synthetic tweets
+tweet_words = {
+    'en': u"the a to and is in it you of for on my that i this with me so be "
+          u"at just have but not your are love like day good new now get "
+          u"time today people great going happy game best win lol really "
+          u"work home night see know want tonight".split(),
+    'de': u"der die das und ist nicht ich du es mit auf ein eine heute "
+          u"morgen gut sehr wieder jetzt noch mal schön leider Spiel neue "
+          u"Zeit Leute immer einfach ganz schon Woche über für Grüße "
+          u"München Berlin".split(),
+    'es': u"el la de que y en un una por con para es no me lo mi muy hoy "
+          u"bien todo más día gracias feliz vida amor partido gente ahora "
+          u"siempre mañana noche también así qué después Madrid".split(),
+    'it': u"il la di che e non un una per con è mi sono ma ci oggi molto "
+          u"bene tutto più giorno grazie vita amore partita gente sempre "
+          u"domani sera anche così perché dopo città Roma".split()}
+
+tweet_apostrophes = {
+    'en': u"don't it's I'm can't won't that's you're we'll she's "
+          u"y'all".split(),
+    'de': u"geht's gibt's hab' wie's".split(),
+    'es': u"'90 d'Artagnan O'Donnell".split(),
+    'it': u"l'app dell'anno c'è un'altra l'ho all'improvviso "
+          u"dell'Italia".split()}
+
+tweet_emoticons = u":) :( :-) :D ;) <3 :P xD :'( ^_^ \u2764 \U0001f602".split()
+
+
+def generate_tweets(lang, n, seed=0):
+    '''Returns n synthetic tweets in lang with mentions, hashtags, URLs,
+    emoticons, numbers and apostrophes
+    '''
+    rng = random.Random('{}-{}'.format(lang, seed))
+    words = tweet_words.get(lang, tweet_words['en'])
+    apostrophes = tweet_apostrophes.get(lang, tweet_apostrophes['en'])
+    alnum = string.ascii_letters + string.digits
+
+    tweets = []
+    for _ in range(n):
+        parts = [rng.choice(words) for _ in range(rng.randint(4, 18))]
+        if rng.random() < 0.3:
+            parts.insert(0, u'@user{}'.format(rng.randint(1, 99999)))
+        if rng.random() < 0.1:
+            parts.insert(0, u'RT')
+        if rng.random() < 0.4:
+            parts.insert(rng.randint(0, len(parts)), rng.choice(apostrophes))
+        if rng.random() < 0.3:
+            number = rng.choice([u'{}', u'{}%', u'{}.5', u'{}:30', u'${}'])
+            parts.insert(rng.randint(0, len(parts)),
+                         number.format(rng.randint(0, 2016)))
+        if rng.random() < 0.4:
+            parts.append(u'#' + rng.choice(words).capitalize())
+        if rng.random() < 0.3:
+            url = u''.join(rng.choice(alnum) for _ in range(10))
+            parts.append(u'http://t.co/' + url)
+        if rng.random() < 0.4:
+            parts.insert(rng.randint(1, len(parts)),
+                         rng.choice(tweet_emoticons))
+        if rng.random() < 0.2:
+            parts[0] = parts[0].upper()
+        text = u' '.join(parts)
+        if rng.random() < 0.3:
+            text += rng.choice([u'!', u'!!!', u'?', u'...', u'.'])
+        tweets.append(text)
+
+    return tweets
+
+
+def throughput(f, items, repeat=1):
+    '''Calls f on each item, returns the number of calls per second
+    '''
+    start = time.time()
+    for _ in range(repeat):
+        for item in items:
+            f(item)
+    elapsed = time.time() - start
+    return (len(items) * repeat) / elapsed
+
+
+def report(name, rate, baseline=None):
+    if baseline:
+        print('{:<30} {:>12.1f}/s  x{:.1f}'.format(name, rate,
+                                                   rate / baseline))
+    else:
+        print('{:<30} {:>12.1f}/s'.format(name, rate))
+
+
+def bench_tagger(config, lang, repeat):
+    '''Stanford NER/POS: nltk (JVM per call) vs stanford_server pool
+    '''
+    stanford_ner = os.path.abspath(config.get('external', 'stanford_ner'))
+    stanford_pos = os.path.abspath(config.get('external', 'stanford_pos'))
+    texts = sample_tweets.get(lang, sample_tweets['en'])
+    tokens = [x.split() for x in texts]
+
+    if config.has_option(lang, 'ner_model'):
+        ner_model = config.get(lang, 'ner_model')
+        model = seq.load_ner(stanford_ner, ner_model)
+        base = throughput(model.tag, tokens)
+        report('ner stanford', base)
+        model = seq.load_ner_server(stanford_ner, ner_model,
+                                    config.getint(lang, 'ner_pool'))
+        report('ner stanford_server', throughput(model.tag, tokens, repeat),
+               base)
+        model.stop()
+
+    if config.has_option(lang, 'pos_model'):
+        pos_model = config.get(lang, 'pos_model')
+        posmap = config.get(lang, 'pos_map')
+        model = seq.load_pos(stanford_pos, pos_model, posmap)
+        base = throughput(model.tag, tokens)
+        report('pos stanford', base)
+        model = seq.load_pos_server(stanford_pos, pos_model, posmap,
+                                    config.getint(lang, 'pos_pool'))
+        report('pos stanford_server', throughput(model.tag, tokens, repeat),
+               base)
+        model.model.stop()
+
+
+def bench_sentiment(config, lang, repeat, batch_size=100):
+    '''sgd.classify (one tweet per predict) vs sgd.classify_many
+    '''
+    clf = sgd.load(config.get(lang, 'sentiment_model'))
+    texts = sample_tweets.get(lang, sample_tweets['en'])
+    texts = [twokenize.tokenize(x) for x in texts]
+    texts = (texts * (batch_size // len(texts) + 1))[:batch_size]
+
+    classify = lambda x: sgd.classify(x, clf, twokenize.preprocess)
+    base = throughput(classify, texts, repeat)
+    report('sentiment classify', base)
+
+    classify_many = lambda x: sgd.classify_many(x, clf, twokenize.preprocess)
+    rate = throughput(classify_many, [texts], repeat) * len(texts)
+    report('sentiment classify_many', rate, base)
+
+
+def check_golden(golden_file='twokenize_golden.jsonl'):
+    '''Checks that the fast tokenizers give the same output as the
+    reference ones on the golden corpus (exits with status 1 if not).
+    Returns the texts.
+    '''
+    texts = []
+    mismatches = 0
+    with io.open(golden_file, encoding='utf8') as fin:
+        for line in fin:
+            golden = json.loads(line)
+            text = golden['text']
+            texts.append(text)
+            if twokenize.tokenize_fast(text) != golden['tokenize']:
+                mismatches += 1
+                print('tokenize_fast mismatch: {!r}'.format(text))
+            if (twokenize.tokenize_apostrophes_fast(text) !=
+                    golden['tokenize_apostrophes']):
+                mismatches += 1
+                print('tokenize_apostrophes_fast mismatch: {!r}'.format(text))
+
+    print('golden corpus: {} texts, {} mismatches'.format(len(texts),
+                                                         mismatches))
+    if mismatches:
+        sys.exit(1)
+    return texts
+
+
+def bench_tokenizer(repeat):
+    '''twokenize.tokenize vs twokenize.tokenize_fast (tweets/sec)
+    '''
+    texts = check_golden()
+    repeat = max(1, repeat // 10)
+
+    base = throughput(twokenize.tokenize, texts, repeat)
+    report('tokenize', base)
+    report('tokenize_fast', throughput(twokenize.tokenize_fast, texts,
+                                       repeat), base)
+
+    base = throughput(twokenize.tokenize_apostrophes, texts, repeat)
+    report('tokenize_apostrophes', base)
+    report('tokenize_apostrophes_fast',
+           throughput(twokenize.tokenize_apostrophes_fast, texts, repeat),
+           base)
+
+
+def normalizer_codes(config):
+    '''(lang, stopwords language) of the configured languages (the items of
+    the codes section would include the config defaults)
+    '''
+    return [(lang, config.get('codes', lang))
+            for lang in config_languages(config)
+            if config.has_option('codes', lang)]
+
+
+def check_normalizer(lang, model, fast, n_tweets=1000):
+    '''Checks that FastNormalizer gives the same output as Normalizer on the
+    sample and synthetic tweets of a language (exits with status 1 if not)
+    '''
+    texts = (sample_tweets.get(lang, sample_tweets['en']) +
+             generate_tweets(lang, n_tweets))
+    texts = [twokenize.tokenize(x) for x in texts]
+    expected = [model.normalize(x) for x in texts]
+    result = [fast.normalize(x) for x in texts]
+    for text, a, b in zip(texts, expected, result):
+        if a != b:
+            print('{} mismatch: {!r}'.format(lang, text))
+    check_same('{} normalizer'.format(lang), expected, result)
+
+
+def bench_normalizer(config, repeat):
+    '''Normalizer vs FastNormalizer for each configured language
+    '''
+    for lang, code in normalizer_codes(config):
+        model = normalize.Normalizer(code)
+        fast = normalize.FastNormalizer(code)
+        check_normalizer(lang, model, fast)
+
+        texts = sample_tweets.get(lang, sample_tweets['en'])
+        texts = [twokenize.tokenize(x) for x in texts]
+        base = throughput(model.normalize, texts, repeat)
+        report('{} normalizer basic'.format(lang), base)
+        report('{} normalizer fast'.format(lang),
+               throughput(fast.normalize, texts, repeat), base)
+
+
+def check_same(name, expected, result):
+    '''Prints whether two arrays of results are identical, exits with
+    status 1 if not
+    '''
+    same = np.array_equal(np.asarray(expected), np.asarray(result))
+    print('{}: {}'.format(name, 'same' if same else 'MISMATCH'))
+    if not same:
+        sys.exit(1)
+
+
+def small_pipeline(n_tweets=2000, seed=0):
+    '''A CountVectorizer + SGD pipeline fitted on synthetic tweets with
+    random labels, returns it and the (preprocessed) tweets
+    '''
+    texts = [twokenize.preprocess(twokenize.tokenize(x))
+             for x in generate_tweets('en', n_tweets, seed)]
+    rng = random.Random(seed)
+    labels = [rng.choice(['NEGATIVE', 'NEUTRAL', 'POSITIVE']) for _ in texts]
+    clf = Pipeline([('vect', CountVectorizer(token_pattern=r"\S+",
+                                             ngram_range=(1, 3),
+                                             binary=True)),
+                    ('sgd', SGDClassifier(random_state=seed))])
+    clf.fit(texts, labels)
+    return clf, texts
+
+
+def check_compact(clf, texts):
+    '''Exports clf in the compact format and checks that the compact model
+    gives the same predictions and scores
+    '''
+    compact_path = tempfile.mkdtemp()
+    try:
+        sgd.export_compact(clf, compact_path)
+        compact = sgd.load_compact(compact_path)
+        check_same('compact predictions', clf.predict(texts),
+                   compact.predict(texts))
+        check_same('compact scores', clf.decision_function(texts),
+                   compact.decision_function(texts))
+    finally:
+        shutil.rmtree(compact_path)
+
+
+def bench_compact(config, lang, repeat):
+    '''joblib pipeline vs compact (memory-mapped) model: load time, same
+    predictions on the golden corpus, classification speed
+    '''
+    sentiment_model = config.get(lang, 'sentiment_model')
+    start = time.time()
+    clf = sgd.load(sentiment_model)
+    print('joblib load: {:.2f}s'.format(time.time() - start))
+
+    compact_path = tempfile.mkdtemp()
+    try:
+        sgd.export_compact(clf, compact_path)
+        start = time.time()
+        compact = sgd.load_compact(compact_path)
+        print('compact load: {:.4f}s'.format(time.time() - start))
+
+        texts = check_golden()
+        texts = [twokenize.preprocess(twokenize.tokenize(x)) for x in texts]
+        check_same('compact predictions', clf.predict(texts),
+                   compact.predict(texts))
+
+        texts = texts[:repeat]
+        base = throughput(lambda x: sgd.classify(x, clf), texts)
+        report('sentiment joblib', base)
+        report('sentiment compact',
+               throughput(lambda x: sgd.classify(x, compact), texts), base)
+    finally:
+        shutil.rmtree(compact_path)
+
+
+def check_fused(clf, texts):
+    '''Checks that the FusedModel compiled from clf gives bit-identical
+    predictions and scores
+    '''
+    fused = sgd.compile_fused(clf)
+    check_same('fused predictions', clf.predict(texts), fused.predict(texts))
+    check_same('fused scores', clf.decision_function(texts),
+               fused.decision_function(texts))
+
+
+def bench_fused(config, lang, repeat):
+    '''sklearn pipeline vs FusedModel: same predictions on the golden corpus,
+    latency of the single tweet path and throughput of the batch path
+    '''
+    clf = sgd.load(config.get(lang, 'sentiment_model'))
+    fused = sgd.compile_fused(clf)
+
+    texts = check_golden()
+    texts = [twokenize.preprocess(twokenize.tokenize(x)) for x in texts]
+    check_fused(clf, texts)
+
+    texts = texts[:repeat]
+    for name, model in [('sklearn', clf), ('fused', fused)]:
+        rate = throughput(lambda x: sgd.classify(x, model), texts)
+        print('{:<30} {:>12.1f}us/tweet'.format(name + ' latency',
+                                                10 ** 6 / rate))
+        rate = throughput(lambda x: sgd.classify_many(x, model), [texts])
+        report(name + ' batch', rate * len(texts))
+
+
+def annotated_docs(n_tweets):
+    '''Synthetic replies with the largest outputs (ngrams, POS and NER tags)
+    '''
+    docs = []
+    for text in generate_tweets('en', n_tweets):
+        tokens = twokenize.tokenize(text).split()
+        docs.append({'lang': 'en', 'text': text,
+                     'tokenized': u' '.join(tokens),
+                     'norm': u' '.join(tokens).lower(),
+                     'ngrams': [u' '.join(tokens[ii:ii + n])
+                                for n in (1, 2, 3)
+                                for ii in range(len(tokens) - n + 1)],
+                     'pos': [[t, u'NOUN'] for t in tokens],
+                     'ne': [[t, u'O'] for t in tokens],
+                     'sentiment': u'POSITIVE'})
+    return docs
+
+
+def bench_wire(repeat, n_tweets=1000):
+    '''JSON vs msgpack encoding of annotated documents (docs/sec, size) and
+    copying vs zero-copy sends of a large batch reply
+    '''
+    docs = annotated_docs(n_tweets)
+    repeat = max(1, repeat // 10)
+
+    base = {}
+    for encoding, name in [(JSON, 'json'), (MSGPACK, 'msgpack')]:
+        msgs = [encode(doc, encoding) for doc in docs]
+        size = sum(len(msg) for msg in msgs) / float(len(msgs))
+        print('{:<30} {:>12.1f} bytes/doc'.format(name + ' size', size))
+        rates = {'encode': throughput(lambda doc: encode(doc, encoding),
+                                      docs, repeat),
+                 'decode': throughput(lambda msg: decode(msg, encoding),
+                                      msgs, repeat)}
+        for step in ('encode', 'decode'):
+            report('{} {}'.format(name, step), rates[step], base.get(step))
+        base = base or rates
+
+    # one batch reply with every document
+    batch = encode(docs, MSGPACK)
+    context = zmq.Context.instance()
+    sender = context.socket(zmq.PAIR)
+    sender.bind('inproc://bench_wire')
+    receiver = context.socket(zmq.PAIR)
+    receiver.connect('inproc://bench_wire')
+    print('{:<30} {:>12.1f} KB'.format('batch reply', len(batch) / 1024.))
+    base = None
+    for copy in (True, False):
+        def send(_):
+            sender.send(batch, copy=copy)
+            receiver.recv(copy=copy)
+        rate = throughput(send, range(100), repeat)
+        report('copy' if copy else 'zero-copy', rate, base)
+        base = base or rate
+    sender.close()
+    receiver.close()
+
+
+def slow_echo(data, delay=0.3):
+    '''Worker function for check_broker_cache: replies with the document
+    after delay seconds, or with an error if its deadline passed
+    '''
+    time.sleep(delay)
+    if time.time() > data.get('deadline', float('inf')):
+        data['error'] = EXPIRED
+    return data
+
+
+def check_broker_cache(delay=0.3):
+    '''Checks that the broker cache does not replay an expired reply: sends a
+    request that expires, then the same request without a deadline twice
+    (the second one should be answered by the cache)
+    '''
+    tmp_dir = tempfile.mkdtemp()
+    frontend_address = 'ipc://{}/frontend'.format(tmp_dir)
+    backend_address = 'ipc://{}/backend'.format(tmp_dir)
+    worker_task = worker_task_builder(partial(slow_echo, delay=delay),
+                                      backend_address)
+    broker_cache = RequestCache(LRUCache(100, 60, 2 ** 20))
+    broker = threading.Thread(target=zserve,
+                              args=(worker_task, 1, backend_address,
+                                    frontend_address),
+                              kwargs={'cache': broker_cache})
+    broker.daemon = True
+    broker.start()
+
+    socket = zmq.Context.instance().socket(zmq.DEALER)
+    socket.connect(frontend_address)
+
+    def request(*body):
+        start = time.time()
+        socket.send_multipart([b""] + list(body))
+        if not socket.poll(30000):
+            raise RuntimeError('no reply from the broker')
+        return json.loads(socket.recv_multipart()[-1]), time.time() - start
+
+    try:
+        payload = json.dumps({'lang': 'en', 'text': 'hello world'})
+        expired, _ = request(JSON, repr(time.time() + delay / 3), payload)
+        fresh, _ = request(payload)
+        cached, elapsed = request(payload)
+        check_same('broker cache after an expired request',
+                   [EXPIRED, None, None, True],
+                   [expired.get('error'), fresh.get('error'),
+                    cached.get('error'), elapsed < delay])
+    finally:
+        socket.close()
+        shutil.rmtree(tmp_dir)
+
+
+def run_checks(config):
+    '''Correctness checks of the fast paths (normalizers of the configured
+    languages, a small fitted pipeline) and of the broker cache
+    '''
+    check_golden()
+    for lang, code in normalizer_codes(config):
+        check_normalizer(lang, normalize.Normalizer(code),
+                         normalize.FastNormalizer(code))
+    clf, texts = small_pipeline()
+    check_compact(clf, texts)
+    check_fused(clf, texts)
+    check_broker_cache()
+
+
+def bench_stages(models, output, lang, texts, repeat):
+    '''Items/sec and tokens/sec of each configured stage and requests/sec of
+    process_message for a language
+    '''
+    results = {}
+
+    def measure(name, f, items, n_tokens):
+        rate = throughput(f, items, repeat)
+        results[name] = {'items_per_sec': rate,
+                         'tokens_per_sec': rate * n_tokens / len(items)}
+        report('{} {}'.format(lang, name), rate)
+
+    tokenized = [models['tokenizer'](x) for x in texts]
+    n_tokens = sum(len(x.split()) for x in tokenized)
+
+    measure('tokenizer', models['tokenizer'], texts, n_tokens)
+    measure('preprocessor', models['preprocessor'], tokenized, n_tokens)
+    if 'normalizer' in models:
+        normalized = [models['normalizer'](x) for x in tokenized]
+        measure('normalizer', models['normalizer'], tokenized, n_tokens)
+        measure('ngrams', lambda x: list(models['ngrams'](x.split())),
+                normalized, n_tokens)
+    if 'sentiment' in models:
+        preprocessed = [models['preprocessor'](x) for x in tokenized]
+        measure('sentiment', models['sentiment'], preprocessed, n_tokens)
+    for name in ['pos', 'ner']:
+        if name in models:
+            # taggers are slow, a sample is enough
+            tokens = [x.split() for x in tokenized]
+            tokens = tokens[:max(1, len(tokens) // 10)]
+            measure(name, models[name], tokens, sum(len(x) for x in tokens))
+
+    # end to end (messages are annotated in place so each call gets a copy)
+    router = {lang: models}
+    outputs = {lang: output}
+    f = lambda text: process_message({'lang': lang, 'text': text}, router,
+                                     outputs)
+    rate = throughput(f, texts, repeat)
+    results['process_message'] = {'requests_per_sec': rate,
+                                  'tokens_per_sec': rate * n_tokens /
+                                  len(texts)}
+    report('{} process_message'.format(lang), rate)
+    return results
+
+
+def git_revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(config, n_tweets, repeat, output_path=None):
+    '''Runs bench_stages for each configured language on synthetic tweets,
+    returns the results (and writes them as JSON to output_path)
+    '''
+    router, outputs = create_router(config)
+    results = {'timestamp': time.time(),
+               'revision': git_revision(),
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'tweets': n_tweets,
+               'repeat': repeat,
+               'languages': {}}
+
+    for lang in config_languages(config):
+        texts = generate_tweets(lang, n_tweets)
+        results['languages'][lang] = bench_stages(router[lang], outputs[lang],
+                                                  lang, texts, repeat)
+
+    if output_path is not None:
+        with open(output_path, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run benchmarks.')
+    parser.add_argument('benchmark', choices=['tagger', 'sentiment',
+                                              'tokenizer', 'normalizer',
+                                              'compact', 'fused', 'suite',
+                                              'wire', 'check'],
+                        help='which benchmark to run')
+    parser.add_argument('--config', type=str, default=None,
+                        help='configuration file')
+    parser.add_argument('--lang', type=str, default='en',
+                        help='language section to benchmark')
+    parser.add_argument('--repeat', type=int, default=100,
+                        help='passes over the sample for the fast paths')
+    parser.add_argument('--tweets', type=int, default=1000,
+                        help='synthetic tweets per language (suite)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='write the suite results to this JSON file')
+
+    args = parser.parse_args()
+    config = read_config_file(init_config(), filepath=args.config)
+
+    if args.benchmark == 'tagger':
+        bench_tagger(config, args.lang, args.repeat)
+    elif args.benchmark == 'sentiment':
+        bench_sentiment(config, args.lang, args.repeat)
+    elif args.benchmark == 'tokenizer':
+        bench_tokenizer(args.repeat)
+    elif args.benchmark == 'normalizer':
+        bench_normalizer(config, args.repeat)
+    elif args.benchmark == 'compact':
+        bench_compact(config, args.lang, args.repeat)
+    elif args.benchmark == 'fused':
+        bench_fused(config, args.lang, args.repeat)
+    elif args.benchmark == 'suite':
+        bench_suite(config, args.tweets, max(1, args.repeat // 100),
+                    args.output)
+    elif args.benchmark == 'wire':
+        bench_wire(args.repeat, args.tweets)
+    elif args.benchmark == 'check':
+        run_checks(config)
+
+
+if __name__ == '__main__':
+    main()
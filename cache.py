@@ -0,0 +1,123 @@
+"""
+Bounded LRU cache for annotation results
+
+Limits: number of entries, time to live (seconds) and memory (bytes, estimated
+from the JSON size of the cached values). A limit of 0 disables it.
+
+RequestCache is used by the broker to answer repeated requests (same payload)
+with the serialized reply without sending them to a worker.
+"""
+
+import json
+import time
+import logging
+import hashlib
+from collections import OrderedDict
+
+
+def text_key(lang, text, outputs, identifier=''):
+    '''Returns the cache key for a document
+    '''
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+    digest = hashlib.sha1(text).digest()
+    return (lang, digest, frozenset(outputs), identifier)
+
+
+class LRUCache():
+    """Least recently used cache with hit/miss counters
+    """
+    def __init__(self, max_entries=10000, ttl=0, max_bytes=0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # key -> (time, value, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        if self.ttl and time.time() - entry[0] > self.ttl:
+            self.bytes -= entry[2]
+            self.misses += 1
+            return default
+
+        # move to the end (most recently used)
+        self.entries[key] = entry
+        self.hits += 1
+        self.bytes_saved += entry[2]
+        return entry[1]
+
+    def put(self, key, value, size=None):
+        if size is None:
+            size = len(json.dumps(value))
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old[2]
+
+        self.entries[key] = (time.time(), value, size)
+        self.bytes += size
+
+        # evict least recently used
+        while self.entries and (
+                (self.max_entries and len(self.entries) > self.max_entries) or
+                (self.max_bytes and self.bytes > self.max_bytes)):
+            _, entry = self.entries.popitem(last=False)
+            self.bytes -= entry[2]
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes_saved': self.bytes_saved,
+                'hit_rate': self.hits / float(lookups) if lookups else 0.0}
+
+
+class RequestCache():
+    """Cache of serialized replies keyed by a hash of the request payload.
+    Remembers the key of each request sent to a worker until its reply comes
+    back. Only replies the worker marked as cacheable (no errors) to requests
+    without a deadline are stored: the deadline is not part of the payload.
+    """
+    def __init__(self, cache, log_interval=60):
+        self.cache = cache
+        self.inflight = {}  # client -> key
+        self.log_interval = log_interval
+        self.last_log = time.time()
+
+    def lookup(self, client, request, deadline=b''):
+        '''Returns the cached reply for request or None
+        '''
+        key = hashlib.sha1(request).digest()
+        reply = self.cache.get(key)
+        if reply is None and not deadline:
+            self.inflight[client] = key
+
+        if time.time() - self.last_log > self.log_interval:
+            self.last_log = time.time()
+            logging.info('broker cache: {}'.format(self.cache.stats()))
+
+        return reply
+
+    def store(self, client, reply, cacheable=True):
+        key = self.inflight.pop(client, None)
+        if key is None or not cacheable:
+            return
+        self.cache.put(key, reply, len(reply))
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Open-loop load generator for the annotator ZMQ frontend and HTTP API
+
+    ./loadtest.py zmq tcp://127.0.0.1:5555 --rates 100,200,400 --connections 4
+    ./loadtest.py http http://127.0.0.1:1984/ --rates 100,200 --connections 16,64
+
+Requests are sent at the target rate (Poisson arrivals) whether or not the
+previous ones were answered, and latency is measured from the time each
+request was scheduled, so a slow service is not hidden by the generator
+waiting for it (coordinated omission).
+
+Each (rate, connections) level runs for --duration seconds and reports the
+latency percentiles (p50 to p99.9), errors and achieved throughput. The
+saturation point is the highest level that still achieves 95% of its target
+rate with less than 1% errors.
+"""
+
+from __future__ import print_function
+import json
+import time
+import random
+import urllib
+import argparse
+from functools import partial
+
+from zmqservice import BrokerConnection, ioloop
+from tornado.httpclient import AsyncHTTPClient
+from benchmark import generate_tweets
+
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentile(values, p):
+    '''p-th percentile of sorted values (nearest rank)
+    '''
+    if not values:
+        return 0.0
+    rank = int(round(p / 100. * (len(values) - 1)))
+    return values[rank]
+
+
+def reply_error(body):
+    '''error of a (JSON) reply body or None, an unparsable body is an error
+    '''
+    try:
+        reply = json.loads(body)
+    except ValueError:
+        return 'invalid reply'
+    error = reply.get('error') if isinstance(reply, dict) else None
+    return None if error in (None, 'none') else error
+
+
+class ZMQSender(object):
+    """Sends requests to the broker frontend over connections DEALER sockets
+    """
+    def __init__(self, address, connections, timeout):
+        self.connection = BrokerConnection(address, connections, timeout)
+
+    def send(self, lang, text, callback):
+        payload = json.dumps({'lang': lang, 'text': text})
+        self.connection.send(payload, partial(self.handle_reply, callback))
+
+    def handle_reply(self, callback, reply):
+        if reply is None:
+            return callback('timeout')
+        callback(reply_error(reply))
+
+    def close(self):
+        for stream in self.connection.streams:
+            stream.close()
+
+
+class HTTPSender(object):
+    """Sends GET requests to the HTTP API with at most connections open
+    """
+    def __init__(self, url, connections, timeout):
+        self.url = url
+        self.timeout = timeout
+        AsyncHTTPClient.configure(None, max_clients=connections)
+        self.client = AsyncHTTPClient(force_instance=True)
+
+    def send(self, lang, text, callback):
+        query = urllib.urlencode({'lang': lang, 'text': text.encode('utf8')})
+        self.client.fetch(self.url + '?' + query,
+                          partial(self.handle_response, callback),
+                          request_timeout=self.timeout)
+
+    def handle_response(self, callback, response):
+        if response.code == 200:
+            return callback(reply_error(response.body))
+        errors = {503: 'overloaded', 504: 'timeout', 599: 'connection'}
+        callback(errors.get(response.code, 'http {}'.format(response.code)))
+
+    def close(self):
+        self.client.close()
+
+
+class LoadRun(object):
+    """Sends requests at rate per second for duration seconds and records
+    the latency of each one from the time it was scheduled
+    """
+    def __init__(self, sender, rate, duration, lang, texts, grace=30,
+                 seed=0):
+        self.sender = sender
+        self.rate = rate
+        self.duration = duration
+        self.lang = lang
+        self.texts = texts
+        self.grace = grace
+        self.rng = random.Random(seed)
+        self.io_loop = ioloop.IOLoop.instance()
+
+        self.latencies = []
+        self.errors = {}
+        self.sent = 0
+        self.completed = 0
+        self.sending = True
+        self.finished = False
+
+    def run(self):
+        self.start = self.next_time = self.io_loop.time()
+        self.end = self.start + self.duration
+        self.last_reply = self.start
+        self.io_loop.add_callback(self.fire)
+        handle = self.io_loop.add_timeout(self.end + self.grace,
+                                          self.io_loop.stop)
+        self.io_loop.start()
+
+        # late replies (after the grace period) are not counted
+        self.finished = True
+        self.io_loop.remove_timeout(handle)
+        return self.results()
+
+    def fire(self):
+        # send everything that is due (even if the loop fell behind)
+        now = self.io_loop.time()
+        while self.next_time <= now and self.next_time < self.end:
+            text = self.texts[self.sent % len(self.texts)]
+            self.sender.send(self.lang, text, partial(self.done,
+                                                      self.next_time))
+            self.sent += 1
+            self.next_time += self.rng.expovariate(self.rate)
+
+        if self.next_time < self.end:
+            self.io_loop.call_at(self.next_time, self.fire)
+        else:
+            self.sending = False
+            self.check_finished()
+
+    def done(self, scheduled, error):
+        if self.finished:
+            return
+        self.last_reply = self.io_loop.time()
+        self.completed += 1
+        if error is None:
+            self.latencies.append(self.last_reply - scheduled)
+        else:
+            self.errors[error] = self.errors.get(error, 0) + 1
+        self.check_finished()
+
+    def check_finished(self):
+        if not self.sending and self.completed == self.sent:
+            self.io_loop.stop()
+
+    def results(self):
+        latencies = sorted(self.latencies)
+        elapsed = max(self.last_reply, self.end) - self.start
+        n_errors = sum(self.errors.values()) + self.sent - self.completed
+        results = {'rate': self.rate,
+                   'sent': self.sent,
+                   'completed': self.completed,
+                   'ok': len(latencies),
+                   'errors': dict(self.errors,
+                                  unanswered=self.sent - self.completed),
+                   'error_rate': n_errors / float(max(1, self.sent)),
+                   'throughput': len(latencies) / elapsed,
+                   'latency': {'mean': sum(latencies) / max(1, len(latencies)),
+                               'max': latencies[-1] if latencies else 0.0}}
+        for p in PERCENTILES:
+            results['latency']['p{}'.format(p)] = percentile(latencies, p)
+        return results
+
+
+def report(level):
+    latency = level['latency']
+    print('{:>8.1f} {:>5} {:>10.1f} {:>7.2%} '.format(
+        level['rate'], level['connections'], level['throughput'],
+        level['error_rate']) +
+        ' '.join('{:>8.1f}'.format(latency['p{}'.format(p)] * 1000)
+                 for p in PERCENTILES) +
+        ' {:>8.1f}'.format(latency['max'] * 1000))
+
+
+def sweep(protocol, address, rates, connections, duration, lang, timeout,
+          n_texts=1000):
+    '''Runs a LoadRun for each (rate, connections) level, returns the results
+    and the saturation point
+    '''
+    texts = generate_tweets(lang, n_texts)
+    print('{:>8} {:>5} {:>10} {:>7} '.format('rate', 'conns', 'throughput',
+                                            'errors') +
+          ' '.join('{:>8}'.format('p{}ms'.format(p)) for p in PERCENTILES) +
+          ' {:>8}'.format('max ms'))
+
+    levels = []
+    saturation = None
+    for n_connections in connections:
+        for rate in rates:
+            if protocol == 'zmq':
+                sender = ZMQSender(address, n_connections, timeout)
+            else:
+                sender = HTTPSender(address, n_connections, timeout)
+            level = LoadRun(sender, rate, duration, lang, texts,
+                            grace=timeout).run()
+            sender.close()
+
+            level['connections'] = n_connections
+            levels.append(level)
+            report(level)
+
+            if (level['throughput'] >= 0.95 * rate and
+                    level['error_rate'] < 0.01):
+                if saturation is None or rate > saturation['rate']:
+                    saturation = {'rate': rate, 'connections': n_connections}
+
+    print('saturation point: {}'.format(saturation))
+    return {'protocol': protocol, 'address': address, 'lang': lang,
+            'duration': duration, 'timestamp': time.time(),
+            'levels': levels, 'saturation': saturation}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the annotator.')
+    parser.add_argument('protocol', choices=['zmq', 'http'],
+                        help='zmq frontend or http api')
+    parser.add_argument('address', type=str,
+                        help='e.g. tcp://127.0.0.1:5555 or http://host:1984/')
+    parser.add_argument('--rates', type=str, default='50,100,200,400',
+                        help='comma separated target requests/sec')
+    parser.add_argument('--connections', type=str, default='8',
+                        help='comma separated numbers of connections')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds per level')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='request timeout (seconds)')
+    parser.add_argument('--lang', type=str, default='en',
+                        help='language of the synthetic tweets')
+    parser.add_argument('--output', type=str, default=None,
+                        help='write the results to this JSON file')
+
+    args = parser.parse_args()
+    rates = [float(x) for x in args.rates.split(',')]
+    connections = [int(x) for x in args.connections.split(',')]
+
+    results = sweep(args.protocol, args.address, rates, connections,
+                    args.duration, args.lang, args.timeout)
+    if args.output is not None:
+        with open(args.output, 'w') as fout:
+            json.dump(results, fout, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
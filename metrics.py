@@ -0,0 +1,182 @@
+"""
+Low overhead metrics: counters, gauges and latency histograms with labels
+
+Workers keep their own registry and send snapshots of it to the broker, which
+merges them with its own metrics and renders everything in the Prometheus
+text format (the /metrics route).
+
+Histograms use fixed log-spaced buckets (10us to ~3min) so they can be merged
+by adding counts. They are exposed as summaries (p50, p95, p99, sum, count).
+"""
+
+import math
+import bisect
+import threading
+
+
+BUCKETS = [1e-5 * 2 ** (ii / 2.) for ii in range(49)]
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram():
+    """Counts of observed values per bucket
+    """
+    def __init__(self, counts=None, total=0.0):
+        self.counts = list(counts or [0] * (len(BUCKETS) + 1))
+        self.total = total
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.total += value
+
+    def merge(self, counts, total):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.total += total
+
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        '''Returns the upper bound of the bucket with the q-quantile
+        '''
+        rank = int(math.ceil(q * self.count()))
+        seen = 0
+        for ii, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS[min(ii, len(BUCKETS) - 1)]
+        return 0.0
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+
+
+class Registry():
+    """Counters, gauges and histograms by (name, labels). Snapshots reported
+    by other processes (workers) are kept by source and added when rendering.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.reports = {}   # source -> snapshot
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def value(self, name, **labels):
+        '''Returns the value of a counter or gauge (0 if not set)
+        '''
+        key = (name, label_key(labels))
+        with self.lock:
+            return self.counters.get(key, self.gauges.get(key, 0))
+
+    def snapshot(self):
+        '''Returns the metrics as a JSON serializable dict
+        '''
+        with self.lock:
+            return {'counters': [[n, l, v]
+                                 for (n, l), v in self.counters.items()],
+                    'gauges': [[n, l, v] for (n, l), v in self.gauges.items()],
+                    'histograms': [[n, l, h.counts, h.total]
+                                   for (n, l), h in self.histograms.items()]}
+
+    def merge(self, snapshot):
+        '''Adds a snapshot to the metrics (gauges are added too)
+        '''
+        with self.lock:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(x) for x in labels))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, value in snapshot['gauges']:
+                key = (name, tuple(tuple(x) for x in labels))
+                self.gauges[key] = self.gauges.get(key, 0) + value
+            for name, labels, counts, total in snapshot['histograms']:
+                key = (name, tuple(tuple(x) for x in labels))
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.merge(counts, total)
+
+    def report(self, source, snapshot):
+        '''Keeps the latest snapshot from source (e.g. a worker)
+        '''
+        with self.lock:
+            self.reports[source] = snapshot
+
+    def retire(self, source):
+        '''Adds the last snapshot from a source that is gone to the metrics
+        '''
+        with self.lock:
+            snapshot = self.reports.pop(source, None)
+        if snapshot is not None:
+            self.merge(snapshot)
+
+    def collect(self):
+        '''Returns a registry with these metrics plus the reported ones
+        '''
+        combined = Registry()
+        combined.merge(self.snapshot())
+        with self.lock:
+            reports = list(self.reports.values())
+        for snapshot in reports:
+            combined.merge(snapshot)
+        return combined
+
+    def render(self):
+        '''Returns the metrics in the Prometheus text format
+        '''
+        lines = []
+        with self.lock:
+            for kind, metrics in [('counter', self.counters),
+                                  ('gauge', self.gauges)]:
+                last = None
+                for (name, labels), value in sorted(metrics.items()):
+                    if name != last:
+                        lines.append('# TYPE {} {}'.format(name, kind))
+                        last = name
+                    lines.append('{}{} {}'.format(name, format_labels(labels),
+                                                  value))
+
+            last = None
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name != last:
+                    lines.append('# TYPE {} summary'.format(name))
+                    last = name
+                for q in QUANTILES:
+                    lines.append('{}{} {}'.format(
+                        name, format_labels(labels, [('quantile', q)]),
+                        h.quantile(q)))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels),
+                                                  h.total))
+                lines.append('{}_count{} {}'.format(
+                    name, format_labels(labels), h.count()))
+
+        return '\n'.join(lines) + '\n'
+
+
+# metrics of this process (each worker has its own)
+registry = Registry()
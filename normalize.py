@@ -4,6 +4,8 @@ Light-weight text normalization and ngram generation
 Requires nltk_download('stopwords')
 """
 
+import re
+import sys
 from unicodedata import category
 from unidecode import unidecode
 from nltk.corpus import stopwords
@@ -34,5 +36,60 @@ class Normalizer():
         return unidecode(text).lower()
 
 
+def punct_regex():
+    '''Returns a regex matching every punctuation character (unicode
+    category P*) built from ranges of consecutive code points
+    '''
+    ranges = []
+    for code in xrange(sys.maxunicode + 1):
+        if not category(unichr(code)).startswith('P'):
+            continue
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    parts = [re.escape(unichr(a)) if a == b else
+             re.escape(unichr(a)) + u'-' + re.escape(unichr(b))
+             for a, b in ranges]
+    return re.compile(u'[' + u''.join(parts) + u']+', re.UNICODE)
+
+
+class FastNormalizer(Normalizer):
+    """Same output as Normalizer: stopwords are a set, punctuation is removed
+    with a single precomputed regex and the transliteration of each token is
+    cached.
+    """
+    punct_re = None
+
+    def __init__(self, lang, cache_size=100000):
+        self.sws = frozenset(stopwords.words(lang))
+        self.cache = {}
+        self.cache_size = cache_size
+        if FastNormalizer.punct_re is None:
+            FastNormalizer.punct_re = punct_regex()
+
+    def remove_punct(self, text):
+        return self.punct_re.sub(u'', text)
+
+    def transliterate(self, token):
+        '''unidecode(token).lower(), cached
+        '''
+        result = self.cache.get(token)
+        if result is None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            result = unidecode(token).lower()
+            self.cache[token] = result
+        return result
+
+    def normalize(self, text):
+        # unidecode maps each character on its own so it can be applied to
+        # each token instead of the whole string
+        text = self.remove_punct(text)
+        sws = self.sws
+        return u' '.join(self.transliterate(x) for x in text.split()
+                         if x not in sws)
+
+
 def normalize(text, model):
     return model.normalize(text)
@@ -3,8 +3,23 @@
 Twitter Annotator Wrapper for Stanford NER/POS
 Requires
 nltk.download('universal_tagset')
+
+The 'stanford' backend uses nltk's taggers which launch a new JVM for every
+call. The 'stanford_server' backend keeps a small pool of warm tagger servers
+running (NERServer/MaxentTaggerServer) and talks to them over a local socket:
+
+    model = load_ner_server(tagger_path, model_path, pool_size=2)
 """
 
+import os
+import time
+import socket
+import atexit
+import logging
+import threading
+import subprocess
+from itertools import cycle
+
 from nltk.tag import StanfordNERTagger, StanfordPOSTagger, map_tag
 
 
@@ -31,6 +46,19 @@ class POSModelWrapper():
         return [(word, map_tag(self.tagmap, 'universal', tag)) 
                 for word, tag in tagged]
 
+    def stop(self):
+        if hasattr(self.model, 'stop'):
+            self.model.stop()
+
+    def tag_sents(self, sentences):
+        tagged = self.model.tag_sents(sentences)
+
+        if not self.tagmap:
+            return tagged
+
+        return [[(word, map_tag(self.tagmap, 'universal', tag))
+                 for word, tag in sentence] for sentence in tagged]
+
 
 def rechunk(ner_output):
     '''Converts
@@ -66,6 +94,21 @@ def ner_tag(tokens, model):
     return rechunk(model.tag(tokens))
 
 
+def tag_many(sentences, model):
+    '''Tags a list of token lists with a single call to the model.
+    Empty token lists are not sent to the tagger.
+    '''
+    non_empty = [x for x in sentences if x]
+    tagged = iter(model.tag_sents(non_empty)) if non_empty else iter([])
+    return [next(tagged) if x else [] for x in sentences]
+
+
+def ner_tag_many(sentences, model):
+    '''Batch version of ner_tag
+    '''
+    return [rechunk(x) for x in tag_many(sentences, model)]
+
+
 def load_pos(tagger_path, model_path, tagset):
     return POSModelWrapper(StanfordPOSTagger(model_path, tagger_path, 'utf8'),
                            tagset)
@@ -73,3 +116,189 @@ def load_pos(tagger_path, model_path, tagset):
 
 def pos_tag(tokens, model):
     return model.tag(tokens)
+
+
+def pos_tag_many(sentences, model):
+    '''Batch version of pos_tag
+    '''
+    return tag_many(sentences, model)
+
+
+#
+# Stanford Server backend
+#
+NER_SERVER_CLASS = 'edu.stanford.nlp.ie.NERServer'
+POS_SERVER_CLASS = 'edu.stanford.nlp.tagger.maxent.MaxentTaggerServer'
+
+
+def free_port(host='127.0.0.1'):
+    '''Returns a currently unused TCP port on host
+    '''
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind((host, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class StanfordServer():
+    '''A single long-lived Stanford tagger JVM listening on a local port.
+    Each tag() call opens a connection, sends one whitespace tokenized line
+    and reads back the tagged line.
+    '''
+    def __init__(self, command, separator, host='127.0.0.1', port=None,
+                 encoding='utf8', timeout=30):
+        self.command = command
+        self.separator = separator
+        self.host = host
+        self.port = port or free_port(host)
+        self.encoding = encoding
+        self.timeout = timeout
+        self.process = None
+        self.restarts = 0
+
+    def start(self, wait=120):
+        '''Launches the JVM and blocks until it accepts connections
+        '''
+        cmd = self.command + ['-port', str(self.port)]
+        logging.info('starting tagger server: {}'.format(' '.join(cmd)))
+        devnull = open(os.devnull, 'w')
+        self.process = subprocess.Popen(cmd, stdout=devnull, stderr=devnull)
+        devnull.close()
+        deadline = time.time() + wait
+        while time.time() < deadline:
+            if not self.alive():
+                raise RuntimeError('tagger server exited on startup')
+            try:
+                socket.create_connection((self.host, self.port), 1).close()
+                return
+            except socket.error:
+                time.sleep(0.25)
+        self.stop()
+        raise RuntimeError('tagger server did not start in {}s'.format(wait))
+
+    def stop(self):
+        if self.process is not None and self.alive():
+            self.process.terminate()
+            self.process.wait()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def tag(self, tokens):
+        '''Returns a list of word-tag pairs
+        '''
+        if not tokens:
+            return []
+        line = u' '.join(tokens).replace(u'\n', u' ') + u'\n'
+        conn = socket.create_connection((self.host, self.port), self.timeout)
+        try:
+            conn.sendall(line.encode(self.encoding))
+            conn.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            conn.close()
+
+        output = b''.join(chunks).decode(self.encoding)
+        tagged = []
+        for word_tag in output.split():
+            word, _, tag = word_tag.rpartition(self.separator)
+            tagged.append((word, tag))
+        return tagged
+
+    def tag_sents(self, sentences):
+        return [self.tag(x) for x in sentences]
+
+
+class StanfordServerPool():
+    '''A small pool of StanfordServer processes for the same model.
+    Requests are spread round-robin, a failed server is skipped and a
+    watchdog thread restarts servers that die (until the pool is stopped).
+
+    Workers forked after the pool is started share the same servers.
+    '''
+    def __init__(self, servers, check_interval=5):
+        self.servers = servers
+        self.check_interval = check_interval
+        self.next_server = cycle(range(len(servers)))
+        self._stopped = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        for server in self.servers:
+            server.start()
+        self._stopped.clear()
+        self._watchdog = threading.Thread(target=self.watch)
+        self._watchdog.daemon = True
+        self._watchdog.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        '''Stops the watchdog, then the servers
+        '''
+        self._stopped.set()
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+        for server in self.servers:
+            server.stop()
+
+    def watch(self):
+        '''Restarts dead servers (runs in the process that started them)
+        '''
+        while not self._stopped.wait(self.check_interval):
+            for server in self.servers:
+                if server.alive():
+                    continue
+                logging.warning('tagger server on port {} died, '
+                                'restarting'.format(server.port))
+                try:
+                    server.restart()
+                except Exception as ex:
+                    logging.exception(ex)
+
+    def tag(self, tokens):
+        error = None
+        for _ in range(len(self.servers)):
+            server = self.servers[next(self.next_server)]
+            try:
+                return server.tag(tokens)
+            except socket.error as ex:
+                error = ex
+        raise error
+
+    def tag_sents(self, sentences):
+        return [self.tag(x) for x in sentences]
+
+
+def load_ner_server(tagger_path, model_path, pool_size=2, java='java',
+                    java_options='-mx1000m'):
+    cmd = [java, java_options, '-cp', tagger_path, NER_SERVER_CLASS,
+           '-loadClassifier', model_path,
+           '-outputFormat', 'slashTags',
+           '-tokenizerFactory', 'edu.stanford.nlp.process.WhitespaceTokenizer',
+           '-tokenizerOptions', 'tokenizeNLs=false']
+    servers = [StanfordServer(cmd, '/') for _ in range(pool_size)]
+    return StanfordServerPool(servers).start()
+
+
+def load_pos_server(tagger_path, model_path, tagset, pool_size=2,
+                    java='java', java_options='-mx1000m'):
+    cmd = [java, java_options, '-cp', tagger_path, POS_SERVER_CLASS,
+           '-model', model_path,
+           '-tokenize', 'false',
+           '-sentenceDelimiter', 'newline',
+           '-tagSeparator', '_']
+    servers = [StanfordServer(cmd, '_') for _ in range(pool_size)]
+    return POSModelWrapper(StanfordServerPool(servers).start(), tagset)
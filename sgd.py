@@ -21,7 +21,9 @@ Where test.txt is line-delimited text
 
     ```
     clf = sgd.load('model_file')
-    sgd.classify(clf, text, preprocess=twokenize.preprocess)
+    # or sgd.load_compact('compact_dir') after sgd.export_compact(clf, ...)
+    sgd.classify(text, clf, preprocess=twokenize.preprocess)
+    sgd.classify_many(texts, clf, preprocess=twokenize.preprocess)
     ```
 
 ### Train
@@ -32,23 +34,35 @@ To train and Test, files should be headerless TSV files with
 """
 
 from __future__ import print_function
+import io
+import os
 import sys
+import math
+import json
+import struct
+import numbers
+import hashlib
+import tempfile
+import operator
 import argparse
 import zmq
 import numpy as np
+import scipy.sparse as sp
 import pandas as pd
 from sklearn.linear_model import SGDClassifier
 from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
 from sklearn.decomposition import TruncatedSVD
 from sklearn.preprocessing import Normalizer
 from sklearn.pipeline import Pipeline
+from sklearn.base import clone
 from sklearn.externals import joblib
 from sklearn.metrics import accuracy_score, f1_score, confusion_matrix
-from sklearn.grid_search import GridSearchCV
+from sklearn.cross_validation import StratifiedKFold
+from sklearn.externals.joblib import Parallel, delayed
 import nltk
 from nltk.corpus import stopwords
 from collections import Counter
-from sklearn.metrics import make_scorer
+from functools import partial
 
 import twokenize
 import undersampler
@@ -94,32 +108,137 @@ def semeval_senti_f1(pred, truth, pos='POSITIVE', neg='NEGATIVE'):
     return (f1_pos + f1_neg) / 2.0
 
 
-def train(train_file, undersample=False, ngram=(1, 4), min_df=1, max_df=1.0,
-          dim_reduction=None, n_dims=0, n_iter=200, class_weight='auto',
-          n_jobs=1, verbose=False):
-    '''Train a classifier
+#
+# Vectorized data cache
+#
+# The vectorized TSV files (sparse matrix, labels and the feature names) are
+# saved with joblib to <cache_dir>/<key>.pkl where key is a hash of the file
+# contents and the vectorizer parameters. CountVectorizer data is cached as
+# raw counts of all the terms: min_df, max_df and binary are applied when it
+# is used (select_features) and evaluation maps the terms to the columns of
+# the model (map_features).
+#
+def file_hash(path, block_size=2 ** 20):
+    '''sha1 of the contents of a file
     '''
-    if verbose:
-        print('loading...')
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(partial(fin.read, block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-    train = pd.read_csv(train_file, delimiter='\t', encoding='utf-8', header=0,
-                        names=['text', 'label'])
-    if undersample != 0:
-        if verbose:
-            print('undersampling (n={})...'.format(undersample))
-        train = undersampler.undersample(train, 'label', undersample)
 
-    X = train['text']
-    Y = np.asarray(train['label'], dtype="|S8")
-    del train
+def counting_vectorizer(vect):
+    '''Returns the vectorizer whose output is cached for vect
+    '''
+    if isinstance(vect, HashingVectorizer):
+        return vect
+    return clone(vect).set_params(min_df=1, max_df=1.0, binary=False,
+                                  max_features=None, vocabulary=None)
+
+
+def read_tsv(path):
+    '''Returns the (texts, labels) of a TSV file
+    '''
+    data = pd.read_csv(path, delimiter='\t', encoding='utf-8', header=0,
+                       names=['text', 'label'])
+    return data['text'], np.asarray(data['label'], dtype="|S8")
+
+
+def load_vectorized(path, vect, cache_dir=None, verbose=False):
+    '''Returns (X, Y, terms) for a TSV file: the texts vectorized by vect
+    (fitted on them unless it is a HashingVectorizer), the labels and the
+    feature names (None for HashingVectorizer). They are read from cache_dir
+    if they were saved there for the same file contents and parameters.
+    '''
+    cache_path = None
+    if cache_dir is not None:
+        params = sorted(vect.get_params().items())
+        key = hashlib.sha1(file_hash(path) + type(vect).__name__ +
+                           repr(params)).hexdigest()
+        cache_path = os.path.join(cache_dir, key + '.pkl')
+        if os.path.exists(cache_path):
+            if verbose:
+                print('loading vectorized {} from cache...'.format(path))
+            return joblib.load(cache_path)
 
     if verbose:
-        count = Counter()
-        count.update(Y)
-        print('num of labels:')
-        print(count)
-        del count
+        print('vectorizing {}...'.format(path))
+    texts, Y = read_tsv(path)
+    if isinstance(vect, HashingVectorizer):
+        X, terms = vect.transform(texts), None
+    else:
+        X, terms = vect.fit_transform(texts), vect.get_feature_names()
+
+    if cache_path is not None:
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+        # unique temporary file so concurrent runs do not write the same one
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            joblib.dump((X, Y, terms), tmp_path)
+            os.rename(tmp_path, cache_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    return X, Y, terms
+
+
+def select_features(X, terms, vect):
+    '''Applies the min_df, max_df and binary parameters of vect to X (raw
+    counts of terms) and sets the vocabulary of vect as if it had been
+    fitted on the same texts. Returns the new X.
+    '''
+    df = np.bincount(X.indices, minlength=X.shape[1])
+    columns = df_columns(df, X.shape[0], vect.min_df, vect.max_df)
+    X = X[:, columns]
+    if vect.binary:
+        X.data[:] = 1
+
+    vect.vocabulary_ = {terms[c]: ii for ii, c in enumerate(columns)}
+    kept = np.zeros(len(terms), dtype=bool)
+    kept[columns] = True
+    vect.stop_words_ = set(terms[c] for c in np.flatnonzero(~kept & (df > 0)))
+    return X
+
+
+def map_features(X, terms, vect):
+    '''Maps X (raw counts of terms) to the columns of a fitted
+    CountVectorizer, the same as vect.transform on the texts
+    '''
+    rows, columns = [], []
+    for ii, term in enumerate(terms):
+        column = vect.vocabulary_.get(term)
+        if column is not None:
+            rows.append(ii)
+            columns.append(column)
+    mapping = sp.csr_matrix((np.ones(len(rows), dtype=X.dtype),
+                             (rows, columns)),
+                            shape=(len(terms), len(vect.vocabulary_)))
+    X = (X * mapping).tocsr()
+    X.sort_indices()
+    if vect.binary:
+        X.data[:] = 1
+    return X
+
+
+def undersample_rows(Y, n=-1):
+    '''Indices of an undersampled (balanced) subset of the labels Y
+    '''
+    df = pd.DataFrame({'label': Y})
+    return undersampler.undersample(df, 'label', n).index.values.astype(int)
 
+
+def train(train_file, undersample=False, ngram=(1, 4), min_df=1, max_df=1.0,
+          dim_reduction=None, n_dims=0, n_iter=200, class_weight='auto',
+          n_jobs=1, verbose=False, cache_dir=None):
+    '''Train a classifier. With cache_dir the vectorized train file is
+    cached there (see load_vectorized).
+    '''
     # create pipeline
     clf = None
 
@@ -154,69 +273,290 @@ def train(train_file, undersample=False, ngram=(1, 4), min_df=1, max_df=1.0,
 
     clf.set_params(**params)
 
+    if verbose:
+        print('loading...')
+
+    if cache_dir is None:
+        train = pd.read_csv(train_file, delimiter='\t', encoding='utf-8',
+                            header=0, names=['text', 'label'])
+        if undersample != 0:
+            if verbose:
+                print('undersampling (n={})...'.format(undersample))
+            train = undersampler.undersample(train, 'label', undersample)
+
+        X = train['text']
+        Y = np.asarray(train['label'], dtype="|S8")
+        del train
+    else:
+        vect = clf.named_steps['vect']
+        X, Y, terms = load_vectorized(train_file, counting_vectorizer(vect),
+                                      cache_dir, verbose)
+        if undersample != 0:
+            if verbose:
+                print('undersampling (n={})...'.format(undersample))
+            rows = undersample_rows(Y, undersample)
+            X, Y = X[rows], Y[rows]
+        if terms is not None:
+            X = select_features(X, terms, vect)
+
+    if verbose:
+        count = Counter()
+        count.update(Y)
+        print('num of labels:')
+        print(count)
+        del count
+
     if verbose:
         print('fitting...')
 
-    clf.fit(X, Y)
+    if cache_dir is None:
+        clf.fit(X, Y)
+    else:
+        # the vectorizer is already fitted, fit the rest of the pipeline
+        Pipeline(clf.steps[1:]).fit(X, Y)
 
     return clf
 
 
-def tune(train_file, n_jobs, verbose, class_weight, stop_words):
-    '''Used for GridSearchCV based parameter tuning
+def read_tsv_chunk(fin, offset, chunk_size):
+    '''Reads at most chunk_size lines of a TSV file starting at offset,
+    returns (texts, labels)
     '''
-    if verbose:
-        print('loading...')
+    fin.seek(offset)
+    lines = []
+    for _ in range(chunk_size):
+        line = fin.readline()
+        if not line:
+            break
+        lines.append(line)
+    if not lines:
+        return [], np.asarray([], dtype="|S8")
 
-    data = pd.read_csv(train_file, delimiter='\t', encoding='utf-8', header=0,
-                       names=['text', 'label'])
-    X = data['text']
-    Y = np.asarray(data['label'], dtype="|S8")
-    del data
+    chunk = pd.read_csv(io.BytesIO(b''.join(lines)), delimiter='\t',
+                        encoding='utf-8', header=None, names=['text', 'label'])
+    return chunk['text'], np.asarray(chunk['label'], dtype="|S8")
+
+
+def scan_tsv(fin, chunk_size):
+    '''Returns the offsets of the chunks of chunk_size lines of a TSV file
+    and the label counts. Like train, the first line is skipped.
+    '''
+    fin.seek(0)
+    fin.readline()
+    offsets = []
+    count = Counter()
+    offset = fin.tell()
+    while True:
+        _, Y = read_tsv_chunk(fin, offset, chunk_size)
+        if not len(Y):
+            break
+        offsets.append(offset)
+        count.update(Y)
+        offset = fin.tell()
+    return offsets, count
+
+
+def train_streaming(train_file, ngram=(1, 4), n_dims=2 ** 20, n_epochs=5,
+                    chunk_size=100000, class_weight='auto', n_jobs=1, seed=0,
+                    verbose=False):
+    '''Train a HashingVectorizer + SGD classifier out-of-core: the TSV is
+    read in chunks of chunk_size lines, in a new random order every epoch,
+    and each chunk is fed to partial_fit. Memory use depends on chunk_size
+    and n_dims, not on the size of the corpus.
+    '''
+    fin = open(train_file, 'rb')
 
-    # create pipeline
-    if stop_words:
-        pipeline = Pipeline([('vect', CountVectorizer(stop_words=stop_words)),
-                             ('sgd', SGDClassifier())])
-    else:
-        pipeline = Pipeline([('vect', CountVectorizer()),
-                             ('sgd', SGDClassifier())])
-    params = {
-        'vect__token_pattern': [r"\S+"],
-        'vect__ngram_range': [(1, 2), (1, 3), (2, 3), (1, 4)],
-        'vect__min_df': [1, 10, 50, 100],
-        'vect__max_df': [1.0, 0.9, 0.8, 0.6],
-        'vect__binary': [True],
-        'sgd__shuffle': [True],
-        'sgd__class_weight': [class_weight]
-    }
-
-    verbose_gv = 0
     if verbose:
-        verbose_gv = 3
+        print('scanning...')
+    offsets, count = scan_tsv(fin, chunk_size)
+    if verbose:
+        print('num of labels:')
+        print(count)
+
+    # partial_fit needs all the classes up front and explicit class weights
+    classes = np.asarray(sorted(count), dtype="|S8")
+    if class_weight is not None:
+        n_samples = sum(count.values())
+        class_weight = {c: n_samples / float(len(count) * n)
+                        for c, n in count.items()}
+
+    vect = HashingVectorizer(token_pattern=r"\S+", ngram_range=ngram,
+                             binary=True, n_features=n_dims)
+    sgd = SGDClassifier(shuffle=True, class_weight=class_weight,
+                        n_jobs=n_jobs, random_state=seed)
+
+    rng = np.random.RandomState(seed)
+    for epoch in range(n_epochs):
+        if verbose:
+            print('epoch {}/{}...'.format(epoch + 1, n_epochs))
+        for offset in rng.permutation(offsets):
+            X, Y = read_tsv_chunk(fin, offset, chunk_size)
+            sgd.partial_fit(vect.transform(X), Y, classes=classes)
+
+    fin.close()
+    return Pipeline([('vect', vect), ('sgd', sgd)])
 
-    scorer_f1 = make_scorer(f1_score, greater_is_better=True)
-    grid_search = GridSearchCV(pipeline, params, n_jobs=n_jobs,
-                               verbose=verbose_gv, scoring=scorer_f1)
+
+TUNE_PARAMS = {'ngram_range': [(1, 2), (1, 3), (2, 3), (1, 4)],
+               'min_df': [1, 10, 50, 100],
+               'max_df': [1.0, 0.9, 0.8, 0.6]}
+
+
+def fold_matrices(X, Y, cv, seed=0):
+    '''Binary count matrices for each (train, test) fold of cv from X, the
+    raw counts of all the terms. Like a CountVectorizer fitted on each
+    training fold without min_df/max_df, which are applied later as column
+    filters (see df_columns). Training rows are shuffled so that their
+    prefixes are samples. Returns [(X_train, Y_train, X_test, Y_test, df)].
+    '''
+    rng = np.random.RandomState(seed)
+    folds = []
+    for train_index, test_index in cv:
+        train_index = rng.permutation(train_index)
+        X_train = X[train_index]
+        df = np.bincount(X_train.indices, minlength=X.shape[1])
+        # the vocabulary of the training fold
+        columns = np.flatnonzero(df)
+        X_train = X_train[:, columns]
+        X_test = X[test_index][:, columns]
+        X_train.data[:] = 1
+        X_test.data[:] = 1
+        folds.append((X_train, Y[train_index], X_test, Y[test_index],
+                      df[columns]))
+    return folds
+
+
+def df_columns(df, n_docs, min_df, max_df):
+    '''Columns kept by CountVectorizer(min_df=min_df, max_df=max_df) given
+    the document frequencies of the columns
+    '''
+    if not isinstance(min_df, numbers.Integral):
+        min_df = min_df * n_docs
+    if not isinstance(max_df, numbers.Integral):
+        max_df = max_df * n_docs
+    return np.flatnonzero((df >= min_df) & (df <= max_df))
+
+
+def score_config(folds, min_df, max_df, class_weight, fraction=1.0):
+    '''Mean f1 over the folds of SGD trained on the first fraction of each
+    training fold, with the columns filtered by min_df/max_df
+    '''
+    scores = []
+    for X_train, Y_train, X_test, Y_test, df in folds:
+        columns = df_columns(df, X_train.shape[0], min_df, max_df)
+        if not len(columns):
+            # CountVectorizer would fail: no terms remain
+            scores.append(0.0)
+            continue
+        n = max(1, int(fraction * X_train.shape[0]))
+        sgd = SGDClassifier(shuffle=True, class_weight=class_weight,
+                            random_state=0)
+        sgd.fit(X_train[:n][:, columns], Y_train[:n])
+        pred = sgd.predict(X_test[:, columns])
+        scores.append(f1_score(Y_test, pred, average='weighted'))
+    return np.mean(scores)
+
+
+def score_configs(train_file, vect, configs, n_jobs, class_weight,
+                  fraction=1.0, n_folds=3, cache_dir=None, verbose=False):
+    '''Scores (ngram_range, min_df, max_df) configurations (see
+    score_config). The folds of one n-gram range are built, used for all its
+    configurations and dropped before the next one.
+    '''
+    scores = {}
+    for ngram in TUNE_PARAMS['ngram_range']:
+        group = [config for config in configs if config[0] == ngram]
+        if not group:
+            continue
+        vect.set_params(ngram_range=ngram)
+        X, Y, _ = load_vectorized(train_file, vect, cache_dir, verbose)
+        folds = fold_matrices(X, Y, StratifiedKFold(Y, n_folds=n_folds))
+        del X
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(score_config)(folds, min_df, max_df, class_weight,
+                                  fraction)
+            for _, min_df, max_df in group)
+        folds = None    # free before building the next ones
+        scores.update(zip(group, results))
+    return [scores[config] for config in configs]
+
+
+def tune(train_file, n_jobs, verbose, class_weight, stop_words,
+         halving=False, eta=3, n_folds=3, cache_dir=None):
+    '''Grid search of the CountVectorizer parameters (TUNE_PARAMS) with
+    cross validation. The count matrices are built for one n-gram range at a
+    time (and cached in cache_dir if given) and min_df/max_df are applied as
+    column filters.
+    With halving (successive halving) all the configurations are first
+    scored on a sample of the training folds and only the best 1/eta go on
+    to a sample eta times larger, up to the full folds. Each round only
+    builds the folds of the n-gram ranges still in the running.
+    '''
+    stop_words = stop_words or None
+    vect = CountVectorizer(token_pattern=r"\S+", stop_words=stop_words)
 
     if verbose:
+        _, Y = read_tsv(train_file)
         count = Counter()
         count.update(Y)
         print('num of labels:')
         print(count)
-        del count
+        del count, Y
+
+    configs = [(ngram, min_df, max_df)
+               for ngram in TUNE_PARAMS['ngram_range']
+               for min_df in TUNE_PARAMS['min_df']
+               for max_df in TUNE_PARAMS['max_df']]
+
+    # fractions of the training folds used in each round
+    fractions = [1.0]
+    if halving:
+        n_rounds = int(math.log(len(configs), eta))
+        fractions = [float(eta) ** -k for k in reversed(range(n_rounds))]
 
     if verbose:
         print('fitting...')
 
-    grid_search.fit(X, Y)
+    for ii, fraction in enumerate(fractions):
+        scores = score_configs(train_file, vect, configs, n_jobs,
+                               class_weight, fraction, n_folds, cache_dir,
+                               verbose)
+        ranked = sorted(zip(scores, configs), key=operator.itemgetter(0),
+                        reverse=True)
+        if verbose:
+            for score, config in ranked:
+                print('\t%r f1=%f' % (config, score))
+            print('%d configurations on %.1f%% of the folds' %
+                  (len(configs), fraction * 100))
+
+        if ii < len(fractions) - 1:
+            n_keep = int(math.ceil(len(configs) / float(eta)))
+            configs = [config for _, config in ranked[:n_keep]]
+
+    ngram, min_df, max_df = ranked[0][1]
+
+    # refit the best configuration on all the data
+    clf = Pipeline([('vect', CountVectorizer(stop_words=stop_words)),
+                    ('sgd', SGDClassifier())])
+    params = {'vect__token_pattern': r"\S+",
+              'vect__ngram_range': ngram,
+              'vect__min_df': min_df,
+              'vect__max_df': max_df,
+              'vect__binary': True,
+              'sgd__shuffle': True,
+              'sgd__class_weight': class_weight}
+    clf.set_params(**params)
+
+    vect.set_params(ngram_range=ngram)
+    X, Y, terms = load_vectorized(train_file, vect, cache_dir, verbose)
+    X = select_features(X, terms, clf.named_steps['vect'])
+    clf.named_steps['sgd'].fit(X, Y)
 
     print("Best parameters set:")
-    best_parameters = grid_search.best_estimator_.get_params()
     for param_name in sorted(params.keys()):
-        print("\t%s: %r" % (param_name, best_parameters[param_name]))
+        print("\t%s: %r" % (param_name, params[param_name]))
 
-    return grid_search.best_estimator_
+    return clf
 
 
 def save(clf, save_path):
@@ -231,6 +571,239 @@ def load(load_path):
     return joblib.load(load_path)
 
 
+#
+# Compact model format
+#
+# A directory of .npy files that are memory-mapped on load so that all the
+# (forked) workers share the same physical pages:
+#   hashes.npy  - sorted 64 bit hashes of the vocabulary terms
+#   offsets.npy - offsets of each term (in hash order) in terms.npy
+#   terms.npy   - utf8 terms concatenated (to check hash matches)
+#   index.npy   - the term's column in the original CountVectorizer
+#   coef.npy    - SGD coefficients, one row per column (n_features, n_coef)
+#   intercept.npy, classes.npy
+#   params.json - the CountVectorizer analyzer parameters
+#
+COMPACT_ANALYZER_PARAMS = ['analyzer', 'binary', 'lowercase', 'ngram_range',
+                           'stop_words', 'strip_accents', 'token_pattern']
+
+
+def term_hash(term):
+    '''64 bit hash of a utf8 encoded term
+    '''
+    return struct.unpack('<Q', hashlib.md5(term).digest()[:8])[0]
+
+
+def export_compact(clf, save_path):
+    '''Saves a CountVectorizer + SGDClassifier pipeline in the compact format
+    '''
+    steps = [name for name, _ in clf.steps]
+    if steps != ['vect', 'sgd'] or \
+            not isinstance(clf.named_steps['vect'], CountVectorizer):
+        raise ValueError('Only CountVectorizer + SGD pipelines can be '
+                         'exported')
+    vect = clf.named_steps['vect']
+    sgd = clf.named_steps['sgd']
+
+    terms = [(term_hash(term.encode('utf8')), term.encode('utf8'), index)
+             for term, index in vect.vocabulary_.items()]
+    terms.sort()
+
+    if not os.path.exists(save_path):
+        os.makedirs(save_path)
+    path = partial(os.path.join, save_path)
+
+    np.save(path('hashes.npy'), np.array([x[0] for x in terms],
+                                         dtype=np.uint64))
+    lengths = [len(x[1]) for x in terms]
+    np.save(path('offsets.npy'), np.concatenate([[0], np.cumsum(lengths)])
+            .astype(np.int64))
+    np.save(path('terms.npy'), np.frombuffer(b''.join(x[1] for x in terms),
+                                             dtype=np.uint8))
+    np.save(path('index.npy'), np.array([x[2] for x in terms],
+                                        dtype=np.int64))
+    np.save(path('coef.npy'), np.ascontiguousarray(sgd.coef_.T,
+                                                   dtype=np.float64))
+    np.save(path('intercept.npy'), sgd.intercept_)
+    np.save(path('classes.npy'), sgd.classes_)
+
+    params = vect.get_params()
+    params = {k: params[k] for k in COMPACT_ANALYZER_PARAMS}
+    with open(path('params.json'), 'w') as fout:
+        json.dump(params, fout)
+
+
+class LinearModel():
+    '''predict/decision_function of a linear classifier (like
+    SGDClassifier's) from the per class scores of each text: subclasses
+    define score(text) and classes_
+    '''
+    def decision_function(self, texts):
+        scores = np.array([self.score(x) for x in texts])
+        if scores.shape[1] == 1:
+            return scores.ravel()
+        return scores
+
+    def predict(self, texts):
+        scores = self.decision_function(texts)
+        if scores.ndim == 1:
+            indices = (scores > 0).astype(np.int)
+        else:
+            indices = scores.argmax(axis=1)
+        return self.classes_[indices]
+
+
+class CompactModel(LinearModel):
+    '''Sentiment model loaded from the compact format. Has the same
+    predict/decision_function results as the exported pipeline.
+    '''
+    def __init__(self, load_path, mmap_mode='r'):
+        path = partial(os.path.join, load_path)
+        # (plain ndarray views of the memory maps are faster to index)
+        load_array = lambda name: np.load(path(name), mmap_mode=mmap_mode) \
+            .view(np.ndarray)
+
+        self.hashes = load_array('hashes.npy')
+        self.offsets = load_array('offsets.npy')
+        self.terms = load_array('terms.npy')
+        self.index = load_array('index.npy')
+        self.coef = load_array('coef.npy')
+        self.intercept = np.load(path('intercept.npy'))
+        self.classes_ = np.load(path('classes.npy'))
+
+        with open(path('params.json')) as fin:
+            params = json.load(fin)
+        params['ngram_range'] = tuple(params['ngram_range'])
+        self.binary = params['binary']
+        self.analyzer = CountVectorizer(**params).build_analyzer()
+
+    def term(self, position):
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.terms[start:end].tostring()
+
+    def lookup(self, terms):
+        '''Returns the columns of a list of (utf8) terms (-1 if not in the
+        vocabulary)
+        '''
+        if not len(self.hashes):
+            return [-1] * len(terms)
+        hashes = np.fromiter((term_hash(x) for x in terms), dtype=np.uint64,
+                             count=len(terms))
+        positions = np.searchsorted(self.hashes, hashes)
+        positions[positions == len(self.hashes)] = 0
+        found = self.hashes[positions] == hashes
+
+        columns = [-1] * len(terms)
+        for ii in np.flatnonzero(found).tolist():
+            position = positions[ii]
+            # check the term itself (hash collisions)
+            while position < len(self.hashes) and \
+                    self.hashes[position] == hashes[ii]:
+                if self.term(position) == terms[ii]:
+                    columns[ii] = self.index[position]
+                    break
+                position += 1
+        return columns
+
+    def score(self, text):
+        counts = Counter(self.analyzer(text))
+        terms = [x.encode('utf8') for x in counts]
+        features = []
+        for column, count in zip(self.lookup(terms), counts.values()):
+            if column >= 0:
+                features.append((column, 1 if self.binary else count))
+
+        if not features:
+            return self.intercept.copy()
+
+        # add in column order (like the sparse dot product) for identical
+        # floating point results
+        features.sort()
+        columns = [x[0] for x in features]
+        values = np.array([x[1] for x in features], dtype=np.float64)
+        weights = self.coef[columns] * values[:, np.newaxis]
+        return weights.cumsum(axis=0)[-1] + self.intercept
+
+
+class FusedModel(LinearModel):
+    '''CountVectorizer + SGDClassifier pipeline compiled into a direct
+    n-gram -> per class weights lookup: the n-grams of a text are looked up
+    as they are generated and their weights added, without building a
+    feature matrix. Same predict/decision_function results as the pipeline.
+    '''
+    def __init__(self, clf):
+        steps = [name for name, _ in clf.steps]
+        if steps != ['vect', 'sgd'] or \
+                not isinstance(clf.named_steps['vect'], CountVectorizer):
+            raise ValueError('Only CountVectorizer + SGD pipelines can be '
+                             'compiled')
+        vect = clf.named_steps['vect']
+        sgd = clf.named_steps['sgd']
+        if vect.analyzer != 'word':
+            raise ValueError('Only word n-grams can be compiled')
+
+        self.vocabulary = vect.vocabulary_
+        # one list of weights (indexed by column) per class
+        self.weights = sgd.coef_.tolist()
+        self.intercept = sgd.intercept_.tolist()
+        self.classes_ = sgd.classes_
+        self.binary = vect.binary
+        self.preprocess = vect.build_preprocessor()
+        self.tokenize = vect.build_tokenizer()
+        self.stop_words = vect.get_stop_words()
+        self.min_n, self.max_n = vect.ngram_range
+
+    def columns(self, text):
+        '''Returns the vocabulary columns of the n-grams in text (a list
+        with repetitions)
+        '''
+        tokens = self.tokenize(self.preprocess(text))
+        if self.stop_words is not None:
+            tokens = [x for x in tokens if x not in self.stop_words]
+
+        get = self.vocabulary.get
+        join = u' '.join
+        n_tokens = len(tokens)
+        columns = []
+        for n in xrange(self.min_n, min(self.max_n, n_tokens) + 1):
+            if n == 1:
+                columns.extend(map(get, tokens))
+            else:
+                columns.extend(map(get, [join(tokens[ii:ii + n]) for ii
+                                         in xrange(n_tokens - n + 1)]))
+        return [x for x in columns if x is not None]
+
+    def score(self, text):
+        # weights are added in column order (like the sparse dot product) and
+        # sum() adds left to right, so the results are identical
+        columns = self.columns(text)
+        if self.binary:
+            columns = sorted(set(columns))
+            return [sum(map(weights.__getitem__, columns)) + b
+                    for weights, b in zip(self.weights, self.intercept)]
+
+        counts = {}
+        for column in columns:
+            counts[column] = counts.get(column, 0) + 1
+        columns = sorted(counts)
+        values = [float(counts[x]) for x in columns]
+        return [sum(map(operator.mul, values,
+                        map(weights.__getitem__, columns))) + b
+                for weights, b in zip(self.weights, self.intercept)]
+
+
+def compile_fused(clf):
+    '''Compiles a trained pipeline into a FusedModel
+    '''
+    return FusedModel(clf)
+
+
+def load_compact(load_path):
+    '''Load a classifier saved with export_compact (memory-mapped)
+    '''
+    return CompactModel(load_path)
+
+
 def run(clf, preprocess=False):
     '''Classify data from stdin
     '''
@@ -260,6 +833,26 @@ def classify(tweet, clf, preprocess=None):
     return clf.predict(line)[0]
 
 
+def classify_many(tweets, clf, preprocess=None):
+    '''Classify a list of tweets/lines/sentences with a single call to
+    predict. Empty texts are classified as default_class.
+    '''
+    if preprocess:
+        tweets = [preprocess(x) for x in tweets]
+    else:
+        tweets = [x.strip() for x in tweets]
+
+    labels = [default_class] * len(tweets)
+    indices = [ii for ii, x in enumerate(tweets) if x]
+    if not indices:
+        return labels
+
+    pred = clf.predict([tweets[ii] for ii in indices])
+    for ii, label in zip(indices, pred):
+        labels[ii] = label
+    return labels
+
+
 def classify_file(clf, test_file):
     '''Classify data stored in a file
     '''
@@ -328,18 +921,36 @@ def plot_cm(cm, labels, destfile='confusion.png'):
 
 
 def evaluate(clf, test_file, undersample=False, calc_semeval_f1=True,
-             export_cm_file=None, verbose=False):
-    '''Evaluate classifier on a given test set.
+             export_cm_file=None, verbose=False, cache_dir=None):
+    '''Evaluate classifier on a given test set. With cache_dir the
+    vectorized test set is cached there (see load_vectorized).
     '''
     if verbose:
         print('evaluating...')
 
-    test = pd.read_csv(test_file, delimiter='\t', encoding='utf-8', header=0,
-                       names=['text', 'label'])
-    if undersample:
-        test = undersampler.undersample(test, 'label')
+    vect = None
+    if cache_dir is not None and isinstance(clf, Pipeline):
+        vect = clf.steps[0][1]
+
+    if isinstance(vect, (CountVectorizer, HashingVectorizer)):
+        # predict with the rest of the pipeline on the cached matrix
+        X, Y, terms = load_vectorized(test_file, counting_vectorizer(vect),
+                                      cache_dir, verbose)
+        if undersample:
+            rows = undersample_rows(Y)
+            X, Y = X[rows], Y[rows]
+        if terms is not None:
+            X = map_features(X, terms, vect)
+        predict = Pipeline(clf.steps[1:]).predict
+    else:
+        test = pd.read_csv(test_file, delimiter='\t', encoding='utf-8',
+                           header=0, names=['text', 'label'])
+        if undersample:
+            test = undersampler.undersample(test, 'label')
 
-    Y = np.asarray(test['label'], dtype="|S8")
+        X = test['text']
+        Y = np.asarray(test['label'], dtype="|S8")
+        predict = clf.predict
 
 
     # labels and their counts
@@ -352,7 +963,7 @@ def evaluate(clf, test_file, undersample=False, calc_semeval_f1=True,
     del count
 
     # predictions
-    pred = clf.predict(test['text'])
+    pred = predict(X)
 
     # calculate accuracy
     acc = accuracy_score(Y, pred)
@@ -394,11 +1005,20 @@ def main():
     parser.add_argument('--save', help='save this model to path')
 
     parser.add_argument('--load', help='path of the model to load')
+
+    parser.add_argument('--export-compact', help='save the model in the '
+                        'compact (memory-mapped) format to this directory')
+
+    parser.add_argument('--load-compact', help='path of the compact model '
+                                               'to load')
     # tune
     parser.add_argument('--tune', action='store_true', help='path of the dev '
                                                             'tsv')
     parser.add_argument('--language', type=str, default=None,
                         help='Use stopwords for this language (nltk only).')
+    parser.add_argument('--halving', action='store_true', default=False,
+                        help='tune with successive halving (eliminates weak '
+                             'configurations on samples of the data)')
 
     # eval, classify file, run, zmq run
     parser.add_argument('--eval', help='path of the test tsv')
@@ -455,6 +1075,20 @@ def main():
     parser.add_argument('--no-auto', action='store_true',
                         default=False)
 
+    parser.add_argument('--streaming', action='store_true', default=False,
+                        help='train out-of-core with hashing and partial_fit '
+                             '(uses --ngrams and --n_dims)')
+
+    parser.add_argument('--epochs', default=5, type=int,
+                        help='passes over the train tsv (streaming)')
+
+    parser.add_argument('--chunk-size', default=100000, type=int,
+                        help='lines read at a time (streaming)')
+
+    parser.add_argument('--cache', type=str, default=None,
+                        help='directory to cache the vectorized train/test '
+                             'files in (train, eval, tune)')
+
     # common options
     parser.add_argument('--n_jobs', type=int, default=-1,
                         help='number of cores to use in parallel')
@@ -466,9 +1100,28 @@ def main():
     args = parser.parse_args()
     verbose = args.verbose
 
+    # streaming always trains a hashing model with partial_fit
+    if args.streaming:
+        if args.tune:
+            parser.error('--tune can not be used with --streaming')
+        if args.dim_reduction not in (None, 'hash'):
+            parser.error('--dim_reduction {} can not be used with '
+                         '--streaming (it always hashes)'.format(
+                             args.dim_reduction))
+        if args.n_iter != parser.get_default('n_iter'):
+            parser.error('--n_iter can not be used with --streaming, '
+                         'use --epochs')
+        for option in ('undersample', 'min_df', 'max_df'):
+            if getattr(args, option) != parser.get_default(option):
+                parser.error('--{} can not be used with '
+                             '--streaming'.format(option))
+        if args.cache and not args.eval:
+            parser.error('--cache only applies to --eval with --streaming')
+
     clf = None
 
-    if not args.train and not args.load and not args.tune:
+    if not args.train and not args.load and not args.tune and \
+            not args.load_compact:
         print('No model loaded')
         parser.print_help()
         sys.exit(1)
@@ -495,14 +1148,21 @@ def main():
     n_dims = 2 ** args.n_dims
 
     # Train
-    if args.train and not args.tune:
+    if args.train and not args.tune and args.streaming:
+        ngram = tuple([int(x) for x in args.ngrams.split(',')])
+        clf = train_streaming(args.train, ngram=ngram, n_dims=n_dims,
+                              n_epochs=args.epochs,
+                              chunk_size=args.chunk_size,
+                              class_weight=class_weight, n_jobs=args.n_jobs,
+                              verbose=verbose)
+    elif args.train and not args.tune:
         ngram = tuple([int(x) for x in args.ngrams.split(',')])
         clf = train(args.train, args.undersample, ngram=ngram,
                     min_df=args.min_df, max_df=args.max_df,
                     dim_reduction=args.dim_reduction,
                     n_dims=n_dims, n_iter=args.n_iter,
                     class_weight=class_weight, n_jobs=args.n_jobs,
-                    verbose=verbose)
+                    verbose=verbose, cache_dir=args.cache)
         if verbose:
             print('ngrams: {}'.format(str(ngram)))
 
@@ -514,7 +1174,8 @@ def main():
     if args.tune:
         clf = tune(args.train, n_jobs=args.n_jobs,
                    verbose=verbose, class_weight=class_weight,
-                   stop_words=stop_words)
+                   stop_words=stop_words, halving=args.halving,
+                   cache_dir=args.cache)
 
     # Load
     if args.load:
@@ -522,6 +1183,11 @@ def main():
             print('loading...')
         clf = load(args.load)
 
+    if args.load_compact:
+        if verbose:
+            print('loading...')
+        clf = load_compact(args.load_compact)
+
     # Save
     if args.save:
         if clf is None:
@@ -529,13 +1195,21 @@ def main():
         else:
             save(clf, args.save)
 
+    # Export
+    if args.export_compact:
+        if clf is None:
+            print('No model to export')
+        else:
+            export_compact(clf, args.export_compact)
+
     # Eval
     if args.eval:
         if clf is None:
             print('No model to evaluate')
         else:
             evaluate(clf, args.eval, args.eval_undersample, 
-                     True, args.eval_cm, verbose=verbose)
+                     True, args.eval_cm, verbose=verbose,
+                     cache_dir=args.cache)
 
     # Run
     if args.run:
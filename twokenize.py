@@ -26,13 +26,17 @@ from __future__ import print_function
 
 import sys
 import os
+import time
 import inspect
 import struct
 import operator
 import re
 import HTMLParser
 import argparse
+import itertools
+import multiprocessing
 from functools import partial
+from collections import deque
 from cStringIO import StringIO
 from base64 import b64decode
 from gzip import GzipFile
@@ -67,9 +71,37 @@ all_emoji_2 = [x.split() for x in all_emoji if len(x.split()) == 2]
 all_emoji_2 = [unichar(int(x[0].strip(), 16)) + unichar(int(x[1].strip(), 16))
                for x in all_emoji_2]
 all_emoji = all_emoji_1 + all_emoji_2
+# first character of every emoji: text without any of them has no emoji
+emoji_start = frozenset(x[0] for x in all_emoji)
 all_emoji = [re.escape(x) for x in all_emoji]
 all_emoji_str = u'(' + ur'|'.join(all_emoji) + u')'
 re_emoji = re.compile(all_emoji_str, re.UNICODE)
+
+
+def char_class(chars):
+    """Regex character class for chars using ranges of consecutive chars"""
+    codes = sorted(set(ord(x) for x in chars))
+    ranges = []
+    for code in codes:
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    parts = [re.escape(unichar(a)) if a == b else
+             re.escape(unichar(a)) + u'-' + re.escape(unichar(b))
+             for a, b in ranges]
+    return u'[' + u''.join(parts) + u']'
+
+# Same matches as re_emoji (single characters are tried before pairs) but
+# as a character class and one small class per pair prefix instead of one
+# alternative per emoji
+emoji_pairs = {}
+for x in all_emoji_2:
+    emoji_pairs.setdefault(x[0], []).append(x[1])
+re_emoji_fast = re.compile(u'(' + char_class(all_emoji_1) + u'|' +
+                           u'|'.join(re.escape(a) + char_class(b)
+                                     for a, b in sorted(emoji_pairs.items())) +
+                           u')', re.UNICODE)
 #
 # End of Emoji
 #
@@ -245,6 +277,7 @@ notEdgePunct = "[a-zA-Z0-9]" # content characters
 offEdge = r"(^|$|:|;|\s|\.|,)"  # colon here gets "(hello):" ==> "( hello ):"
 EdgePunctLeft  = re.compile(offEdge + "("+edgePunct+"+)("+notEdgePunct+")", re.UNICODE)
 EdgePunctRight = re.compile("("+notEdgePunct+")("+edgePunct+"+)" + offEdge, re.UNICODE)
+EdgePunctAny = re.compile(edgePunct, re.UNICODE)
 
 # number
 # numbers can include .,/ e.g. 12,399.05 or 12.2.2005 or 12/2/2005
@@ -327,6 +360,30 @@ def simpleTokenize(text):
     
     return zippedStr
 
+# Same tokens as simpleTokenize in fewer passes.
+# simpleTokenize ends by joining all tokens and splitting on whitespace, so
+# the goods/bads bookkeeping reduces to putting spaces around the protected
+# spans and the emoji and splitting once.
+def simpleTokenizeFast(text):
+    if EdgePunctAny.search(text):
+        text = splitEdgePunct(text)
+
+    pieces = []
+    last = 0
+    for match in Protected.finditer(text):
+        start, end = match.span()
+        if start != end:
+            pieces.append(text[last:start])
+            pieces.append(text[start:end])
+            last = end
+    pieces.append(text[last:])
+    text = u' '.join(pieces)
+
+    if not emoji_start.isdisjoint(text):
+        text = re_emoji_fast.sub(u' \\1 ', text)
+
+    return text.split()
+
 def addAllnonempty(master, smaller):
     for s in smaller:
         strim = s.strip()
@@ -346,15 +403,20 @@ def splitToken(token):
     return [token]
 
 # Assume 'text' has no HTML escaping.
-def tokenize1(text):
+def tokenize1(text, fast=False):
+    if fast:
+        return simpleTokenizeFast(squeezeWhitespace(text))
     return simpleTokenize(squeezeWhitespace(text))
 
 
-def tokenize2(text):
+def tokenize2(text, fast=False):
     """Breaks apostrophes:
         l'ammore -> ["l'", "ammore"]
         """
-    tokens = simpleTokenize(squeezeWhitespace(text))
+    if fast:
+        tokens = simpleTokenizeFast(squeezeWhitespace(text))
+    else:
+        tokens = simpleTokenize(squeezeWhitespace(text))
     ntoks = []
     for tok in tokens:
         if '\'' in tok:
@@ -368,10 +430,11 @@ def tokenize2(text):
             ntoks.extend([tok])
     return ntoks
 
-def tokenize(text, break_apostrophes=False):
+def tokenize(text, break_apostrophes=False, fast=False):
     """Returns tokenized text
     Expects unicode or utf8 encoded text
     Returns unicode string (the tokenized text seperated by space)
+    fast uses simpleTokenizeFast (same output)
     """
     tokens = []
     text = text.strip()
@@ -385,9 +448,9 @@ def tokenize(text, break_apostrophes=False):
 
     # tokenize
     if break_apostrophes:
-        tokens = tokenize2(text)
+        tokens = tokenize2(text, fast)
     else:
-        tokens = tokenize1(text)
+        tokens = tokenize1(text, fast)
 
     text = u' '.join(tokens)
 
@@ -396,6 +459,8 @@ def tokenize(text, break_apostrophes=False):
 
 # Partial
 tokenize_apostrophes = partial(tokenize, break_apostrophes=True)
+tokenize_fast = partial(tokenize, fast=True)
+tokenize_apostrophes_fast = partial(tokenize, break_apostrophes=True, fast=True)
 
 
 # Twitter text comes HTML-escaped, so unescape it.
@@ -435,10 +500,109 @@ def preprocess(tokenized_text):
     return text  
 
 
+def tokenize_line(line, tsv=False, break_apostrophes=False, fast=False,
+                  do_preprocess=True):
+    """Returns the utf8 output line (without the newline) for a line of text
+    or TSV (the first column is tokenized), None if the text is empty
+    """
+    if tsv:
+        line = line.decode('utf8')
+        fields = line.split(u'\t')
+        line = fields[0]
+        others = u'\t'.join(fields[1:]).strip().encode('utf8')
+
+    text = tokenize(line, break_apostrophes, fast)
+    if do_preprocess:
+        text = preprocess(text)
+
+    if not text:
+        return None
+
+    text = text.encode('utf8')
+    if tsv:
+        return text + '\t' + others
+    return text
+
+
+def tokenize_lines(lines, **kwargs):
+    return [tokenize_line(line, **kwargs) for line in lines]
+
+
+def open_file(path, mode='rb'):
+    """Opens a file, gzip compressed if path ends with .gz"""
+    if path.endswith('.gz'):
+        return GzipFile(path, mode)
+    return open(path, mode)
+
+
+def read_chunks(fin, chunk_size):
+    while True:
+        lines = list(itertools.islice(fin, chunk_size))
+        if not lines:
+            return
+        yield lines
+
+
+def write_lines(fout, lines, results, ignore=False):
+    for line, text in zip(lines, results):
+        if text is None and not ignore:
+            print('Empty line in result')
+            print(line)
+            sys.exit(1)
+        elif text is not None:
+            fout.write(text + '\n')
+
+
+def tokenize_file(infile, outfile, n_jobs=1, chunk_size=10000, ignore=False,
+                  report_interval=10, **kwargs):
+    """Tokenizes infile into outfile in chunks of chunk_size lines on n_jobs
+    processes, the output is in input order. kwargs are passed to
+    tokenize_line. Returns the number of lines read.
+    """
+    f = partial(tokenize_lines, **kwargs)
+    pool = multiprocessing.Pool(n_jobs) if n_jobs > 1 else None
+    pending = deque()   # (lines, async result)
+    n_lines = 0
+    start = last_report = time.time()
+
+    def report():
+        elapsed = max(time.time() - start, 1e-6)
+        print('{} lines, {:.1f} lines/s'.format(n_lines, n_lines / elapsed))
+
+    with open_file(infile) as fin, open_file(outfile, 'wb') as fout:
+        for lines in read_chunks(fin, chunk_size):
+            if pool is None:
+                write_lines(fout, lines, f(lines), ignore)
+                n_lines += len(lines)
+            else:
+                pending.append((lines, pool.apply_async(f, (lines,))))
+
+            # keep a bounded number of chunks in flight
+            while len(pending) > 2 * n_jobs:
+                lines, result = pending.popleft()
+                write_lines(fout, lines, result.get(), ignore)
+                n_lines += len(lines)
+
+            if time.time() - last_report > report_interval:
+                last_report = time.time()
+                report()
+
+        while pending:
+            lines, result = pending.popleft()
+            write_lines(fout, lines, result.get(), ignore)
+            n_lines += len(lines)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    report()
+    return n_lines
+
+
 def main():
     parser = argparse.ArgumentParser(description='Run tokenizer (twokenize).')
-    parser.add_argument('input_file', help='the input file')
-    parser.add_argument('output_file', help='the output file')
+    parser.add_argument('input_file', help='the input file (.gz for gzip)')
+    parser.add_argument('output_file', help='the output file (.gz for gzip)')
 
     parser.add_argument('--tsv', action='store_true', default=False,
                         help='input and output are TSV files not text')
@@ -446,41 +610,25 @@ def main():
                         help='preprocess text')
     parser.add_argument('--apostrophes', action='store_true',
                         default=False, help="don't becomes d' ont")
+    parser.add_argument('--fast', action='store_true',
+                        default=False, help='use the fast tokenizer')
     parser.add_argument('--ignore', action='store_true',
                         default=False, help='ignores if in/out text is empty')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes (0 for one per core)')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='lines per chunk')
 
     # Parse
     args = parser.parse_args()
-    infile = args.input_file
-    outfile = args.output_file
-    ignore = args.ignore
-
-
-    with open(infile) as fin, open(outfile, 'w') as fout:
-        for line in fin:
-            if args.tsv:
-                line = line.decode('utf8')
-                fields = line.split(u'\t')
-                line = fields[0]
-                others = u'\t'.join(fields[1:]).strip().encode('utf8')
-
-            text = tokenize(line, args.apostrophes)
-            if args.preprocess:
-                text = preprocess(text)
-
-            if not text and not ignore:
-                print('Empty line in result')
-                print(line)
-                sys.exit(1)
-
-            elif not text and ignore:
-                continue
-
-            text = text.encode('utf8')
-            if args.tsv:
-                fout.write(text + '\t' + others + '\n')
-            else:
-                fout.write(text + '\n')
+    n_jobs = args.jobs
+    if n_jobs <= 0:
+        n_jobs = multiprocessing.cpu_count()
+
+    tokenize_file(args.input_file, args.output_file, n_jobs, args.chunk_size,
+                  args.ignore, tsv=args.tsv, break_apostrophes=args.apostrophes,
+                  fast=args.fast, do_preprocess=args.preprocess)
+
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,14 @@
+#!/usr/bin/env python
 '''
-Implements undersampling for pandas dataframes
+Implements undersampling for pandas dataframes and (streaming) TSV files
+
+    ./undersampler.py train.tsv balanced.tsv --n 100000 --shuffle
 '''
 
+from __future__ import print_function
+import argparse
 import numpy as np
-from collections import Counter
+import pandas as pd
 
 
 def undersample(df, label_column, n=-1, seed=-1):
@@ -13,35 +18,100 @@ def undersample(df, label_column, n=-1, seed=-1):
     Warning: dataframe is NOT shuffled. Examples will be ordered by class.
     Note: Algorithms such as scikit learn SGD can do their own shuffling
     '''
+    rng = np.random.RandomState(None if seed < 0 else seed)
 
-    # determine smallest class
-    counter = Counter()
-    counter.update(df[label_column])
-    smallest_class, smallest_n = counter.most_common()[-1]
-    classes = counter.keys()    # classes in dataset
+    # class of each row (-1 for missing labels)
+    codes, classes = pd.factorize(df[label_column])
+    counts = np.bincount(codes[codes >= 0], minlength=len(classes))
 
     # determine n
+    smallest_n = counts.min()
     if n <= 0 or n > smallest_n:
         n = smallest_n
 
-    # this approach is inefficient but meh
-    selected = np.array([])
+    # sort rows by class and a random key, keep the first n of each class
+    rows = np.flatnonzero(codes >= 0)
+    order = rows[np.lexsort((rng.random_sample(len(rows)), codes[rows]))]
+    sorted_codes = codes[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_codes, sorted_codes)
+    selected = order[rank < n]
+
+    # change the dataframe
+    return df.iloc[selected]
+
 
-    # seed random choices
-    if seed < 0:
-        np.random.seed()
-    else:
-        np.random.seed(seed)
+def undersample_file(input_path, output_path, n, label_column=1,
+                     delimiter='\t', header=False, shuffle=False, seed=-1):
+    '''Undersamples a TSV file in a single pass keeping at most n lines per
+    class in memory (a reservoir sample of each class). Writes the same
+    number of lines of each class: n or the size of the smallest class.
+    Lines are ordered by class unless shuffle. Returns the number per class.
+    '''
+    if n <= 0:
+        raise ValueError('n must be positive')
+    rng = np.random.RandomState(None if seed < 0 else seed)
 
-    # for each class
-    for c in classes:
-        # determine indices
-        indices = df[df[label_column] == c].index.values
-        # select
-        indices = np.random.choice(indices, n, replace=False)
-        selected = np.concatenate((selected, indices), axis=0)
+    reservoirs = {}     # class -> lines
+    seen = {}           # class -> count
+    first_line = None
+    with open(input_path, 'rb') as fin:
+        if header:
+            first_line = fin.readline()
+        for line in fin:
+            fields = line.rstrip(b'\r\n').split(delimiter)
+            if len(fields) <= label_column:
+                continue
+            label = fields[label_column]
+            reservoir = reservoirs.setdefault(label, [])
+            count = seen.get(label, 0) + 1
+            seen[label] = count
+            if count <= n:
+                reservoir.append(line)
+            else:
+                ii = rng.randint(count)
+                if ii < n:
+                    reservoir[ii] = line
 
+    # a random subset of a reservoir is a sample of the class
+    n = min(len(x) for x in reservoirs.values()) if reservoirs else 0
+    lines = []
+    for label in sorted(reservoirs):
+        reservoir = reservoirs[label]
+        rng.shuffle(reservoir)
+        lines.extend(reservoir[:n])
+    if shuffle:
+        rng.shuffle(lines)
 
-    # change the dataframe
-    df = df.loc[selected]
-    return df
+    with open(output_path, 'wb') as fout:
+        if first_line is not None:
+            fout.write(first_line)
+        for line in lines:
+            fout.write(line if line.endswith(b'\n') else line + b'\n')
+
+    return n
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Undersample a TSV file.')
+    parser.add_argument('input_file', help='the input TSV file')
+    parser.add_argument('output_file', help='the output TSV file')
+    parser.add_argument('--n', type=int, required=True,
+                        help='at most n examples per class')
+    parser.add_argument('--label-column', type=int, default=1,
+                        help='column of the class value')
+    parser.add_argument('--header', action='store_true', default=False,
+                        help='copy the first line to the output')
+    parser.add_argument('--shuffle', action='store_true', default=False,
+                        help='shuffle the output (default: ordered by class)')
+    parser.add_argument('--seed', type=int, default=-1,
+                        help='random seed')
+
+    args = parser.parse_args()
+    n = undersample_file(args.input_file, args.output_file, args.n,
+                         args.label_column, header=args.header,
+                         shuffle=args.shuffle, seed=args.seed)
+    print('{} examples per class'.format(n))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,56 +12,517 @@ Brandon Carpenter (hashstat) <brandon(dot)carpenter(at)pnnl(dot)gov>
 http://zguide.zeromq.org/py:lbbroker
 """
 
+import os
+import math
+import time
+import signal
 import logging
 import multiprocessing
 import threading
 import json
+import struct
+import itertools
 import zmq
+from collections import deque, OrderedDict
 from zmq.eventloop import ioloop, zmqstream
 from functools import partial
 
+import metrics
+from annotator import EXPIRED
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 ioloop.install()
 
 import tornado
 from tornado import web
 
 
-def worker_task_builder(worker_f, backend_address):
+# first frame of a micro-batch message between broker and workers
+BATCH = b'BATCH'
+
+# worker <-> broker signals
+READY = b'READY'
+HEARTBEAT = b'HEARTBEAT'
+STATS = b'STATS'
+
+# seconds between the metrics reports of each worker
+STATS_INTERVAL = 5
+
+# last frame of a worker reply that the broker can cache (one without errors)
+CACHEABLE = b'CACHEABLE'
+
+# request/reply encodings, clients select msgpack with a frame before the
+# payload (no frame means JSON)
+JSON = b''
+MSGPACK = b'MSGPACK'
+
+# messages of at least this many bytes are sent without copying
+ZERO_COPY_THRESHOLD = 64 * 1024
+
+# seconds between heartbeats and number of missed heartbeats before the other
+# side is considered gone
+DEFAULT_HEARTBEAT = 1.0
+HEARTBEAT_LIVENESS = 3
+
+
+def encode(data, encoding=JSON):
+    """Serializes a reply (JSON if msgpack is not available)"""
+    if encoding == MSGPACK and msgpack is not None:
+        return msgpack.packb(data, use_bin_type=False)
+    return json.dumps(data)
+
+
+def decode(msg, encoding=JSON):
+    """Deserializes a request, msg can be bytes or a zmq.Frame (msgpack
+    reads the frame's buffer without copying it)
+    """
+    if encoding == MSGPACK:
+        if msgpack is None:
+            raise ValueError('msgpack is not installed')
+        if isinstance(msg, zmq.Frame):
+            msg = msg.buffer
+        return msgpack.unpackb(msg, raw=False)
+    elif encoding != JSON:
+        raise ValueError('unsupported encoding: {}'.format(encoding))
+
+    if isinstance(msg, zmq.Frame):
+        msg = msg.bytes
+    return json.loads(msg)
+
+
+def send_frames(socket, frames):
+    """Sends a multipart message, without copying it if it is large"""
+    size = sum(len(frame) for frame in frames)
+    socket.send_multipart(frames, copy=size < ZERO_COPY_THRESHOLD)
+
+
+def worker_task_builder(worker_f, backend_address, batch_f=None,
+                        heartbeat=DEFAULT_HEARTBEAT):
     """Returns the multiprocess worker the function that calls
     process_message()
+
+    Idle workers and the broker exchange heartbeats every heartbeat seconds;
+    a worker exits if it stops hearing from the broker. Every STATS_INTERVAL
+    seconds a worker sends its metrics instead of a heartbeat.
+
+    A message that is a JSON array is a batch: it is passed to batch_f
+    (e.g. process_messages()) and the reply is an array in the same order.
+
+    A BATCH message from the broker (micro-batching) carries several client
+    requests: their documents are annotated with a single call to batch_f
+    and the replies are split back per client.
+
+    Each request is decoded and its reply encoded with the encoding chosen by
+    its client (JSON or MSGPACK). A deadline sent with a request (in its own
+    frame) is set on the documents that do not have their own.
+
+    Replies without errors are marked CACHEABLE for the broker cache.
     """
+    if batch_f is None:
+        batch_f = lambda data: [worker_f(data=x) for x in data]
+
+    def set_deadline(data, deadline):
+        if not deadline:
+            return
+        deadline = float(deadline)
+        for doc in (data if isinstance(data, list) else [data]):
+            if isinstance(doc, dict):
+                doc.setdefault('deadline', deadline)
+
+    def status(reply):
+        """CACHEABLE if no document in reply has an error"""
+        docs = reply if isinstance(reply, list) else [reply]
+        if any(not isinstance(doc, dict) or 'error' in doc for doc in docs):
+            return b''
+        return CACHEABLE
+
+    def handle(msg, encoding=JSON, deadline=b''):
+        """Returns the (serialized) reply to a single request and its
+        status"""
+        reply = {'error': 'none'}
+
+        try:
+            data = decode(msg, encoding)
+            set_deadline(data, deadline)
+            if isinstance(data, list):
+                reply = batch_f(data=data)
+            else:
+                reply = worker_f(data=data)
+        except Exception as e:
+            logging.exception(e)
+            reply = {'error': str(e)}
+
+        return encode(reply, encoding), status(reply)
+
+    def handle_batch(frames):
+        """Returns [client, reply, status, client, ...] for a BATCH message
+        of [client, encoding, deadline, request, client, ...]
+        """
+        clients, msgs = frames[0::4], frames[3::4]
+        encodings = [frame.bytes for frame in frames[1::4]]
+        deadlines = [frame.bytes for frame in frames[2::4]]
+
+        try:
+            data = [decode(msg, encoding)
+                    for msg, encoding in zip(msgs, encodings)]
+            for d, deadline in zip(data, deadlines):
+                set_deadline(d, deadline)
+            docs = []
+            for d in data:
+                docs.extend(d if isinstance(d, list) else [d])
+            results = iter(batch_f(data=docs))
+            replies = []
+            for d, encoding in zip(data, encodings):
+                if isinstance(d, list):
+                    reply = [next(results) for _ in d]
+                else:
+                    reply = next(results)
+                replies.append((encode(reply, encoding), status(reply)))
+        except Exception as e:
+            # fallback to handling each request on its own
+            logging.exception(e)
+            replies = [handle(msg, encoding, deadline) for msg, encoding,
+                       deadline in zip(msgs, encodings, deadlines)]
+
+        frames = []
+        for client, (reply, reply_status) in zip(clients, replies):
+            frames.extend([client, reply, reply_status])
+        return frames
 
     def worker_task(worker_id):
-        # setup service
-        socket = zmq.Context().socket(zmq.REQ)
+        # metrics of this worker only
+        metrics.registry = registry = metrics.Registry()
+        started = time.time()
+
+        # setup service, unsent messages are dropped on exit (the broker
+        # may be gone)
+        context = zmq.Context()
+        socket = context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
         socket.identity = u"Worker-{}".format(worker_id).encode("ascii")
         socket.connect(backend_address)
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
 
         # signal to the broker that we are ready
-        socket.send(b'READY')
+        socket.send_multipart([b"", READY])
+        last_heard = time.time()
+        next_heartbeat = last_heard + heartbeat
+        next_stats = last_heard + STATS_INTERVAL
 
         # start working (pun intended)
         while True:
-            address, _, msg = socket.recv_multipart()
-            reply = {'error': 'none'}
+            timeout = max(0, next_heartbeat - time.time())
+            if poller.poll(timeout * 1000):
+                # drop the empty delimiter, payloads are not copied
+                frames = socket.recv_multipart(copy=False)[1:]
+                kind = frames[0].bytes
+                start = time.time()
+                if kind == BATCH:
+                    send_frames(socket, [b"", BATCH] +
+                                handle_batch(frames[1:]))
+                elif kind != HEARTBEAT:
+                    address, encoding, deadline, msg = frames
+                    reply, reply_status = handle(msg, encoding.bytes,
+                                                 deadline.bytes)
+                    send_frames(socket, [b"", address, b"", reply,
+                                         reply_status])
+                last_heard = time.time()
+                if kind != HEARTBEAT:
+                    registry.inc('annotator_worker_busy_seconds_total',
+                                 last_heard - start)
+            elif time.time() - last_heard > heartbeat * HEARTBEAT_LIVENESS:
+                logging.error('worker {}: broker is gone'.format(worker_id))
+                socket.close()
+                context.term()
+                return
+
+            if time.time() >= next_stats:
+                registry.set('annotator_worker_uptime_seconds',
+                             time.time() - started)
+                socket.send_multipart([b"", STATS,
+                                       json.dumps(registry.snapshot())])
+                next_stats = time.time() + STATS_INTERVAL
+                next_heartbeat = time.time() + heartbeat
+            elif time.time() >= next_heartbeat:
+                socket.send_multipart([b"", HEARTBEAT])
+                next_heartbeat = time.time() + heartbeat
 
-            try:
-                data = json.loads(msg)
-                reply = worker_f(data=data)
-            except Exception as e:
-                logging.exception(e)
-                reply = {'error': str(e)}
+    return worker_task
 
-            reply = json.dumps(reply)
-            socket.send_multipart([address, b"", reply])
 
-    return worker_task
+def recv_request(frontend):
+    """Receives a client request, returns its routing envelope (the frames
+    before the empty delimiter: the client identity and, for DEALER clients,
+    their request id), its encoding and deadline and the payload.
+
+    The body is [payload], [encoding, payload] or [encoding, deadline,
+    payload] (deadline as a unix time string). The deadline is kept out of
+    the payload so that the broker cache can match identical requests.
+    """
+    frames = frontend.recv_multipart()
+    delimiter = frames.index(b"")
+    body = frames[delimiter + 1:]
+    encoding = body[0] if len(body) > 1 else JSON
+    deadline = body[1] if len(body) > 2 else b""
+    return frames[:delimiter], encoding, deadline, body[-1]
 
 
-def zserve(worker_task, n_workers, backend_address, frontend_address):
+class Requests(object):
+    """Routing envelopes (and arrival times) of the client requests being
+    processed. Workers only see a short key for each request.
+    """
+    def __init__(self, registry=None):
+        self.envelopes = {}
+        self.counter = itertools.count()
+        self.registry = registry or metrics.Registry()
+
+    def add(self, envelope, encoding=JSON):
+        """Returns the key for a new request"""
+        key = struct.pack('!Q', next(self.counter))
+        self.envelopes[key] = (time.time(), envelope, encoding)
+        self.registry.inc('annotator_requests_total')
+        return key
+
+    def dispatched(self, key):
+        """Records how long a request waited before going to a worker"""
+        arrival = self.envelopes.get(key, (None,))[0]
+        if arrival is not None:
+            self.registry.observe('annotator_queue_seconds',
+                                  time.time() - arrival)
+
+    def reply(self, frontend, key, reply):
+        """Sends the reply for a request back to its client. Replies from the
+        broker itself (dicts) are encoded with the request's encoding.
+        """
+        arrival, envelope, encoding = self.envelopes.pop(key,
+                                                         (None, None, None))
+        if envelope is not None:
+            if not isinstance(reply, bytes):
+                reply = encode(reply, encoding)
+            frames = envelope + [b""]
+            if encoding != JSON:
+                frames.append(encoding)
+            frontend.send_multipart(frames + [reply])
+            self.registry.observe('annotator_request_seconds',
+                                  time.time() - arrival)
+
+
+def send_replies(frontend, requests, replies, cache=None):
+    """Sends (key, reply, cacheable) triples back to their clients"""
+    for client, reply, cacheable in replies:
+        requests.reply(frontend, client, reply)
+        if cache is not None:
+            cache.store(client, reply, cacheable)
+
+
+class WorkerPool(object):
+    """The worker processes as seen by the broker.
+
+    Keeps the idle workers (oldest first) and the requests each busy worker
+    is processing. Workers that die, stop sending heartbeats while idle or
+    take more than timeout seconds on a request are killed and replaced.
+    Their requests are re-queued (at most retries times), after that the
+    client gets an error reply.
+
+    Worker counts and the metrics reported by the workers go to registry.
+    """
+    def __init__(self, backend, worker_task, n_workers,
+                 heartbeat=DEFAULT_HEARTBEAT, timeout=60, retries=1,
+                 log_interval=60, registry=None):
+        self.backend = backend
+        self.registry = registry or metrics.Registry()
+        self.worker_task = worker_task
+        self.n_workers = n_workers
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+        self.retries = retries
+        self.log_interval = log_interval
+
+        self.processes = {}         # identity -> process
+        self.idle = OrderedDict()   # identity -> last heard from (time)
+        self.busy = {}              # identity -> (start time, items, batch)
+        self.attempts = {}          # client -> times re-queued
+        self.requeued = deque()     # (client, encoding, deadline, request)
+        self.ids = itertools.count()
+        self.restarts = 0
+        self.failed = 0
+        self.rejected = 0
+        self.service_time = 0.0     # smoothed seconds per request
+        self.next_check = time.time() + heartbeat
+        self.last_log = time.time()
+
+    def start(self):
+        for _ in range(self.n_workers):
+            self.spawn()
+
+    def spawn(self):
+        """Starts a worker process"""
+        worker_id = next(self.ids)
+        process = multiprocessing.Process(target=self.worker_task,
+                                          args=(worker_id,))
+        process.daemon = True
+        process.start()
+        identity = u"Worker-{}".format(worker_id).encode("ascii")
+        self.processes[identity] = process
+
+    def send(self, items, batch=False):
+        """Sends [(client, encoding, deadline, request), ...] to the next idle
+        worker"""
+        worker, _ = self.idle.popitem(last=False)
+        self.busy[worker] = (time.time(), items, batch)
+        if batch:
+            frames = []
+            for item in items:
+                frames.extend(item)
+            self.backend.send_multipart([worker, b"", BATCH] + frames)
+        else:
+            self.backend.send_multipart([worker, b""] + list(items[0]))
+
+    def recv(self):
+        """Handles a message from a worker, returns the [(client, reply,
+        cacheable)] it carries
+        """
+        frames = self.backend.recv_multipart()
+        worker, _, kind = frames[:3]
+        if worker not in self.processes:
+            # replaced worker
+            return []
+
+        if kind in (HEARTBEAT, STATS):
+            if kind == STATS:
+                self.registry.report(worker, json.loads(frames[3]))
+            if worker in self.idle:
+                self.idle[worker] = time.time()
+            return []
+
+        now = time.time()
+        if worker in self.busy:
+            start, items, _ = self.busy.pop(worker)
+            self.service_time = (0.9 * self.service_time +
+                                 0.1 * (now - start) / len(items))
+        self.idle[worker] = now
+
+        if kind == READY:
+            return []
+        if kind == BATCH:
+            replies = frames[3:]
+            replies = zip(replies[0::3], replies[1::3],
+                          [x == CACHEABLE for x in replies[2::3]])
+        else:
+            replies = [(kind, frames[4], frames[5] == CACHEABLE)]
+        for client, _, _ in replies:
+            self.attempts.pop(client, None)
+        return replies
+
+    def check(self):
+        """Replaces failed workers and heartbeats the idle ones. Returns the
+        [(client, error reply, False)] for requests that will not be retried.
+        """
+        now = time.time()
+        if now < self.next_check:
+            return []
+        self.next_check = now + self.heartbeat
+
+        replies = []
+        for worker, process in self.processes.items():
+            if not process.is_alive():
+                reason = 'died'
+            elif (worker in self.busy and
+                    now - self.busy[worker][0] > self.timeout):
+                reason = 'timed out'
+            elif (worker in self.idle and
+                    now - self.idle[worker] > self.heartbeat *
+                    HEARTBEAT_LIVENESS):
+                reason = 'missed heartbeats'
+            else:
+                continue
+            replies.extend(self.replace(worker, reason))
+
+        for worker in self.idle:
+            self.backend.send_multipart([worker, b"", HEARTBEAT])
+
+        self.registry.set('annotator_workers', len(self.idle), state='idle')
+        self.registry.set('annotator_workers', len(self.busy), state='busy')
+
+        if now - self.last_log > self.log_interval:
+            self.last_log = now
+            logging.info('workers: {}'.format(self.stats()))
+
+        return replies
+
+    def replace(self, worker, reason):
+        """Kills a worker, starts a new one and re-queues its requests"""
+        process = self.processes.pop(worker)
+        if process.is_alive():
+            process.terminate()
+            process.join(0.1)
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGKILL)
+        process.join(0.1)
+        self.idle.pop(worker, None)
+        _, items, _ = self.busy.pop(worker, (None, [], None))
+
+        self.restarts += 1
+        self.registry.inc('annotator_worker_restarts_total')
+        self.registry.retire(worker)
+        logging.warning('{} {}, restarting ({} restarts)'.format(
+            worker, reason, self.restarts))
+        self.spawn()
+
+        replies = []
+        for item in items:
+            client = item[0]
+            attempts = self.attempts.get(client, 0)
+            if attempts < self.retries:
+                self.attempts[client] = attempts + 1
+                self.requeued.append(item)
+            else:
+                self.attempts.pop(client, None)
+                self.failed += 1
+                self.registry.inc('annotator_requests_failed_total')
+                replies.append((client,
+                                {'error': 'worker {}'.format(reason)},
+                                False))
+        return replies
+
+    def overloaded(self, depth):
+        """Reply for a request that did not fit in a queue of depth requests:
+        an error with the estimated seconds until the queue is processed
+        """
+        self.rejected += 1
+        self.registry.inc('annotator_requests_rejected_total')
+        retry_after = depth * self.service_time / max(1, self.n_workers)
+        return {'error': 'overloaded',
+                'retry_after': max(1, int(math.ceil(retry_after)))}
+
+    def stats(self):
+        return {'workers': len(self.processes),
+                'idle': len(self.idle),
+                'busy': len(self.busy),
+                'restarts': self.restarts,
+                'requeued': len(self.requeued),
+                'failed': self.failed,
+                'rejected': self.rejected}
+
+
+def zserve(worker_task, n_workers, backend_address, frontend_address,
+           batch_size=0, batch_wait=5, cache=None,
+           heartbeat=DEFAULT_HEARTBEAT, worker_timeout=60, max_queue=0,
+           registry=None):
     """Load balancer: Starts the workers (in different processes) and
     balances the work it receives from a client between the different worker
-    processes.
+    processes. Failed workers are replaced (see WorkerPool).
+
+    If batch_size > 1 requests are micro-batched (see balance_batches).
+    If a cache (cache.RequestCache) is passed, repeated requests are answered
+    by the broker without going to a worker.
+    At most max_queue requests wait for a worker (0 for no limit).
+    Broker and worker metrics go to registry (a metrics.Registry).
     """
 
     # Prepare context and sockets
@@ -72,101 +533,366 @@ def zserve(worker_task, n_workers, backend_address, frontend_address):
     backend.bind(backend_address)
 
     # Start Workers
-    def start(task, *args):
-        """A function that starts background processes"""
-        process = multiprocessing.Process(target=task, args=args)
-        process.daemon = True
-        process.start()
+    pool = WorkerPool(backend, worker_task, n_workers, heartbeat,
+                      worker_timeout, registry=registry)
+    pool.start()
 
-    for i in range(n_workers):
-        start(worker_task, i)
+    if batch_size > 1:
+        balance_batches(frontend, pool, batch_size, batch_wait, cache,
+                        max_queue)
+    else:
+        balance(frontend, pool, cache, max_queue)
 
+    # Clean up
+    backend.close()
+    frontend.close()
+    context.term()
+
+
+def balance(frontend, pool, cache=None, max_queue=0):
+    """Sends each client request to the next idle worker. Requests wait in a
+    queue of at most max_queue requests (0 for no limit), when it is full
+    they are rejected (see WorkerPool.overloaded).
+    """
     # Initialize main loop state
-    workers = []
+    requests = Requests(pool.registry)
+    pending = deque()   # (client, encoding, deadline, request)
     poller = zmq.Poller()
 
-    poller.register(backend, zmq.POLLIN)
+    poller.register(pool.backend, zmq.POLLIN)
+    poller.register(frontend, zmq.POLLIN)
 
     while True:
-        sockets = dict(poller.poll())
+        sockets = dict(poller.poll(pool.heartbeat * 1000))
 
         #
         # Handle worker activity on the backend
         #
-        if backend in sockets:
-            request = backend.recv_multipart()
-            worker, _, client = request[:3]
-
-            if not workers:
-                # Client polling was suspended - unsuspend it:
-                # (if we got a msg from a worker it means it is availabe
-                # Poll for clients now that a worker is available
-                poller.register(frontend, zmq.POLLIN)
-
-            workers.append(worker)
-            if client != b"READY" and len(request) > 3:
-                # If client reply, send rest back to frontend
-                _, reply = request[3:]
-                frontend.send_multipart([client, b"", reply])
+        if pool.backend in sockets:
+            send_replies(frontend, requests, pool.recv(), cache)
+        send_replies(frontend, requests, pool.check(), cache)
+
+        # Requests from failed workers go first
+        while pool.requeued:
+            pending.appendleft(pool.requeued.pop())
+
         #
-        # Get next client request, route to last-used worker
+        # Queue client requests
         #
         if frontend in sockets:
-            client, _, request = frontend.recv_multipart()
-            worker = workers.pop(0)
-            backend.send_multipart([worker, b"", client, b"", request])
-            if not workers:
-                # Suspend client polling
-                # Don't poll clients if no workers are available
-                poller.unregister(frontend)
+            envelope, encoding, deadline, request = recv_request(frontend)
+            client = requests.add(envelope, encoding)
+            reply = None
+            if cache is not None:
+                reply = cache.lookup(client, request, deadline)
+            if reply is None and max_queue and len(pending) >= max_queue:
+                reply = pool.overloaded(len(pending))
+            if reply is not None:
+                send_replies(frontend, requests, [(client, reply, False)],
+                             cache)
+            else:
+                pending.append((client, encoding, deadline, request))
 
-    # Clean up
-    backend.close()
-    frontend.close()
-    context.term()
+        #
+        # Route queued requests to the idle workers
+        #
+        while pool.idle and pending:
+            item = pending.popleft()
+            requests.dispatched(item[0])
+            pool.send([item])
+        pool.registry.set('annotator_queue_depth', len(pending))
+
+
+def balance_batches(frontend, pool, batch_size, batch_wait, cache=None,
+                    max_queue=0):
+    """Micro-batching load balancer: client requests are queued and sent to an
+    idle worker as a single BATCH message of up to batch_size requests. As in
+    balance, the queue is limited to max_queue requests.
+
+    The target batch size follows the (smoothed) queue depth: under light
+    load requests are dispatched immediately, under heavy load the broker
+    waits at most batch_wait milliseconds for a batch to fill up.
+    """
+    requests = Requests(pool.registry)
+    pending = deque()   # (arrival time, (client, encoding, deadline, request))
+    depth = 1.0         # smoothed queue depth
+    poller = zmq.Poller()
+
+    poller.register(pool.backend, zmq.POLLIN)
+    poller.register(frontend, zmq.POLLIN)
+
+    while True:
+        # wake up when the oldest pending request has waited long enough
+        timeout = pool.heartbeat * 1000
+        if pending and pool.idle:
+            waited = (time.time() - pending[0][0]) * 1000
+            timeout = min(timeout, max(0, batch_wait - waited))
+
+        sockets = dict(poller.poll(timeout))
+
+        #
+        # Handle worker activity on the backend
+        #
+        if pool.backend in sockets:
+            send_replies(frontend, requests, pool.recv(), cache)
+        send_replies(frontend, requests, pool.check(), cache)
+
+        # Requests from failed workers go first
+        while pool.requeued:
+            pending.appendleft((0, pool.requeued.pop()))
+
+        #
+        # Queue client requests
+        #
+        if frontend in sockets:
+            envelope, encoding, deadline, request = recv_request(frontend)
+            client = requests.add(envelope, encoding)
+            reply = None
+            if cache is not None:
+                reply = cache.lookup(client, request, deadline)
+            if reply is None and max_queue and len(pending) >= max_queue:
+                reply = pool.overloaded(len(pending))
+            if reply is not None:
+                send_replies(frontend, requests, [(client, reply, False)],
+                             cache)
+            else:
+                pending.append((time.time(),
+                                (client, encoding, deadline, request)))
+                depth = 0.9 * depth + 0.1 * len(pending)
+
+        #
+        # Send batches to idle workers
+        #
+        while pool.idle and pending:
+            target = int(min(batch_size, max(1, round(depth))))
+            waited = (time.time() - pending[0][0]) * 1000
+            if len(pending) < target and waited < batch_wait:
+                break
+
+            items = []
+            for _ in range(min(batch_size, len(pending))):
+                _, item = pending.popleft()
+                requests.dispatched(item[0])
+                items.append(item)
+            pool.send(items, batch=True)
+        pool.registry.set('annotator_queue_depth', len(pending))
+
+
+class BrokerConnection(object):
+    """A few long-lived DEALER sockets to the broker shared by all the HTTP
+    requests. Each request is tagged with an id and its reply is dispatched
+    to its callback. Requests that time out get None instead.
+    """
+    def __init__(self, address, n_sockets=2, timeout=30, io_loop=None):
+        context = zmq.Context.instance()
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.timeout = timeout
+        self.pending = {}   # request id -> (callback, timeout handle)
+        self.counter = itertools.count()
+
+        self.streams = []
+        for _ in range(n_sockets):
+            s = context.socket(zmq.DEALER)
+            s.setsockopt(zmq.SNDHWM, 0)
+            s.setsockopt(zmq.RCVHWM, 0)
+            s.connect(address)
+            stream = zmqstream.ZMQStream(s, self.io_loop)
+            stream.on_recv(self.handle_reply)
+            self.streams.append(stream)
+        self.next_stream = itertools.cycle(self.streams)
+
+    def send(self, payload, callback, timeout=None, deadline=None):
+        """Sends a JSON payload, callback gets the reply (None if there is
+        none within timeout seconds). deadline (unix time) is sent in its own
+        frame for the workers.
+        """
+        request_id = struct.pack('!Q', next(self.counter))
+        if timeout is None:
+            timeout = self.timeout
+        handle = self.io_loop.add_timeout(self.io_loop.time() + timeout,
+                                          partial(self.expire, request_id))
+        self.pending[request_id] = (callback, handle)
+        frames = [request_id, b"", payload]
+        if deadline is not None:
+            frames = [request_id, b"", JSON, repr(deadline), payload]
+        next(self.next_stream).send_multipart(frames)
+
+    def handle_reply(self, msg):
+        request_id, _, reply = msg
+        callback, handle = self.pending.pop(request_id, (None, None))
+        if callback is None:
+            # already timed out
+            return
+        self.io_loop.remove_timeout(handle)
+        callback(reply)
+
+    def expire(self, request_id):
+        callback, _ = self.pending.pop(request_id, (None, None))
+        if callback is not None:
+            callback(None)
 
 
 class WebHandler(tornado.web.RequestHandler):
-    def initialize(self, address):
-        self.address = address
+    def initialize(self, connection):
+        self.connection = connection
+        self.closed = False
+
+    def on_connection_close(self):
+        self.closed = True
+
+    def request_timeout(self):
+        """Seconds the client is willing to wait: the X-Timeout header, at
+        most the connection timeout (None if the header is not valid). Sets
+        the deadline sent to the workers if there is a header (replies to
+        requests with a deadline are not cached by the broker).
+        """
+        timeout = self.connection.timeout
+        self.deadline = None
+        if 'X-Timeout' in self.request.headers:
+            try:
+                value = float(self.request.headers['X-Timeout'])
+            except ValueError:
+                return None
+            if not 0 <= value < float('inf'):
+                return None
+            timeout = min(timeout, value)
+            self.deadline = time.time() + timeout
+        return timeout
+
+    def bad_request(self, error):
+        self.set_status(400)
+        self.write({'error': error})
+        self.finish()
 
     @web.asynchronous
     def get(self):
-        ctx = zmq.Context.instance()
-        s = ctx.socket(zmq.REQ)
-        s.connect(self.address)
+        timeout = self.request_timeout()
+        if timeout is None:
+            return self.bad_request('invalid X-Timeout')
 
         # get the parameters
         try:
             lang = self.get_query_argument('lang')
             text = self.get_query_argument('text')
-            jsdata = json.dumps({'text': text, 'lang': lang})
+            data = {'text': text, 'lang': lang}
+            annotations = self.get_query_argument('annotations', None)
+            if annotations is not None:
+                data['annotations'] = annotations
+            jsdata = json.dumps(data, sort_keys=True)
 
             # send request to worker
-            s.send(jsdata)
-            self.stream = zmqstream.ZMQStream(s)
-            self.stream.on_recv(self.handle_reply)
+            self.connection.send(jsdata, self.handle_reply, timeout,
+                                 self.deadline)
         except Exception as ex:
             self.write({'error': str(ex)})
             self.finish()
 
+    @web.asynchronous
+    def post(self):
+        """Batch request: the body is a JSON array of documents or NDJSON
+        (one document per line) if the content type says so. The reply uses
+        the same format with the results in the same order.
+        """
+        content_type = self.request.headers.get('Content-Type', '')
+        self.ndjson = 'ndjson' in content_type
+        timeout = self.request_timeout()
+        if timeout is None:
+            return self.bad_request('invalid X-Timeout')
+
+        try:
+            body = self.request.body.decode('utf-8')
+            if self.ndjson:
+                docs = [json.loads(x) for x in body.splitlines() if x.strip()]
+            else:
+                docs = json.loads(body)
+            if not isinstance(docs, list):
+                raise ValueError('batch must be a JSON array')
+
+            # send request to worker
+            self.connection.send(json.dumps(docs, sort_keys=True),
+                                 self.handle_batch_reply, timeout,
+                                 self.deadline)
+        except Exception as ex:
+            self.write({'error': str(ex)})
+            self.finish()
+
+    def handle_timeout(self):
+        self.set_status(504)
+        self.write({'error': 'timeout'})
+        self.finish()
+
+    def set_error_status(self, reply):
+        """503 (with Retry-After) if the broker is overloaded, 504 if the
+        deadline passed before the request was processed
+        """
+        error = reply.get('error')
+        if error == 'overloaded':
+            self.set_status(503)
+            self.set_header('Retry-After', reply['retry_after'])
+        elif error == EXPIRED:
+            self.set_status(504)
+
     def handle_reply(self, msg):
         # finish web request with worker's reply
-        reply = json.loads(msg[0])
-        self.stream.close()
+        if self.closed:
+            return
+        if msg is None:
+            return self.handle_timeout()
+        reply = json.loads(msg)
+        self.set_error_status(reply)
         self.write(reply)
         self.finish()
 
+    def handle_batch_reply(self, msg):
+        # tornado will not write a list so the body is written as is
+        if self.closed:
+            return
+        if msg is None:
+            return self.handle_timeout()
+        reply = json.loads(msg)
+        if isinstance(reply, dict):
+            # error
+            self.set_error_status(reply)
+            self.write(reply)
+        elif self.ndjson:
+            self.set_header('Content-Type', 'application/x-ndjson')
+            self.write(u'\n'.join(json.dumps(x) for x in reply) + u'\n')
+        else:
+            self.set_header('Content-Type', 'application/json')
+            self.write(msg)
+        self.finish()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Broker and worker metrics in the Prometheus text format"""
+    def initialize(self, registry):
+        self.registry = registry
+
+    def get(self):
+        combined = self.registry.collect()
+        busy = combined.value('annotator_worker_busy_seconds_total')
+        uptime = combined.value('annotator_worker_uptime_seconds')
+        if uptime:
+            combined.set('annotator_worker_busy_ratio', busy / uptime)
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(combined.render())
+
 
-def serve(port, worker_task, n_workers, backend_address, frontend_address):
+def serve(port, worker_task, n_workers, backend_address, frontend_address,
+          batch_size=0, batch_wait=5, cache=None, n_connections=2,
+          timeout=30, heartbeat=DEFAULT_HEARTBEAT, worker_timeout=60,
+          max_queue=0):
 
+    registry = metrics.Registry()
     zserver_f = partial(zserve, worker_task, n_workers, backend_address,
-                        frontend_address)
+                        frontend_address, batch_size, batch_wait, cache,
+                        heartbeat, worker_timeout, max_queue, registry)
     worker = threading.Thread(target=zserver_f)
     worker.daemon = True
     worker.start()
 
-    d = {'address': frontend_address}
+    connection = BrokerConnection(frontend_address, n_connections, timeout)
+    d = {'connection': connection}
 
     import sys
 
@@ -176,7 +902,9 @@ def serve(port, worker_task, n_workers, backend_address, frontend_address):
         sys.stdout.write('.')
         sys.stdout.flush()
 
-    application = tornado.web.Application([(r"/", WebHandler, d)])
+    application = tornado.web.Application([
+        (r"/", WebHandler, d),
+        (r"/metrics", MetricsHandler, {'registry': registry})])
     beat = ioloop.PeriodicCallback(dot, 1000)
     beat.start()
     application.listen(port)